@@ -0,0 +1,413 @@
+"""
+Runs glue tasks against a fake host and checks their round trips, bytes
+and wall time against budgets, so changes to glue.bottle can be measured
+without a server:
+
+    python -m glue.benchmark
+    python -m glue.benchmark --latency=0.05 --tasks=update,syncmedia
+    python -m glue.benchmark --record=budgets.json     # new budgets
+    python -m glue.benchmark --budgets=budgets.json
+
+The fake host answers every command in-process after `latency` seconds,
+with canned output for the commands whose output glue reads. Nothing is
+run locally or remotely. It uses the project's settings when
+DJANGO_SETTINGS_MODULE is set, and a stand-in project otherwise.
+"""
+import base64
+import json
+import optparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+
+# what each task may cost against the fake host, at the default latency
+BUDGETS = {
+    'update': {'round_trips': 10, 'bytes': 8192, 'seconds': 3.0},
+    'bootstrap': {'round_trips': 52, 'bytes': 40960, 'seconds': 5.0},
+    'syncmedia': {'round_trips': 5, 'bytes': 12288, 'seconds': 3.0},
+    'fixprojectperms': {'round_trips': 1, 'bytes': 4096, 'seconds': 1.0},
+}
+
+# (pattern, output) for commands whose output glue reads. output may be a
+# function of the command
+RESPONSES = [
+    (r'glue-reload', 'glue-reload ok 0.0 0.5'),
+    (r'git rev-parse HEAD && git pull', '0' * 40 + '\nAlready up-to-date.'),
+    (r'rev-parse HEAD', '0' * 40),
+    (r'supervisorctl pid', '1234'),
+    (r'manage.py migrate', 'glue-start 0.0\nglue-migrate 0.1 glue-rc 0\nglue-end 0.5'),
+]
+
+# how many files the syncmedia scenario has on each side, and how many
+# differ
+MEDIA_FILES = 200
+MEDIA_CHANGED = 10
+
+
+def _decoded(command):
+    """
+    The script behind a _shell_script() command, or the command itself
+    """
+    match = re.search(r'echo ([A-Za-z0-9+/=]{8,}) \| base64 -d', command)
+    if match:
+        try:
+            return base64.b64decode(match.group(1))
+        except TypeError:
+            pass
+    return command
+
+
+class FakeHost(object):
+    """
+    Stands in for fabric's run/sudo/put/local and the ssh connections
+    """
+    def __init__(self, latency=0.0, responses=()):
+        self.latency = latency
+        self.responses = list(responses) + RESPONSES
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def answer(self, command):
+        for pattern, output in self.responses:
+            if re.search(pattern, command):
+                return callable(output) and output(command) or output
+        return ''
+
+    def result(self, out, return_code=0):
+        from fabric.operations import _AttributeString
+        result = _AttributeString(out)
+        result.return_code = return_code
+        result.failed = return_code != 0
+        result.succeeded = not result.failed
+        result.stderr = ''
+        return result
+
+    def execute(self, command):
+        """
+        Output of command; batch scripts get every command answered with
+        the markers glue expects
+        """
+        self.wait()
+        script = _decoded(command)
+        markers = re.findall(r"printf '\\n(__glue_\w+) (\d+) %s\\n'", script)
+        if not markers:
+            return self.result(self.answer(script))
+        out = []
+        lines = script.splitlines()
+        for token, index in markers:
+            line = [i for i, l in enumerate(lines) if "'\\n%s %s %%s\\n'" % (token, index) in l][0]
+            out.append('\n%s %s 0.0' % (token, index))
+            out.append(self.answer(lines[line + 1]))
+            out.append('\n%s %s 0 0.0' % (token, index))
+        return self.result('\n'.join(out))
+
+    def run(self, command, *args, **kwargs):
+        return self.execute(command)
+
+    def sudo(self, command, *args, **kwargs):
+        return self.execute(command)
+
+    def put(self, local_path, remote_path, *args, **kwargs):
+        self.wait()
+        return [remote_path]
+
+    def local(self, command, capture=False, *args, **kwargs):
+        return self.result(self.answer(command))
+
+    def rsync(self, paths, source, target, streams):
+        self.wait()
+
+    def exists(self, path, use_sudo=False, verbose=False):
+        return not self.execute('stat "$(echo %s)"' % path).failed
+
+
+class _Channel(object):
+    """
+    An ssh channel: a warm shell answering its markers, a stream that
+    swallows what is sent, or a forwarded redis/memcached port
+    """
+    def __init__(self, host, port=None):
+        self.host, self.port = host, port
+        self.shell, self.buffer, self.pending = False, '', ''
+
+    def exec_command(self, command):
+        self.host.wait()
+        self.shell = not re.search(r'tar -x|cat >', command)
+
+    def sendall(self, data):
+        if self.port:
+            self.buffer += self.port == 6379 and ':1\r\n' or '1\r\n'
+            return
+        if not self.shell:
+            return
+        self.pending += data
+        while '\n' in self.pending:
+            line, self.pending = self.pending.split('\n', 1)
+            token = re.search(r"printf '(__glue_\w+) ", line)
+            if not token:
+                continue
+            command = re.search(r'\( (.*) \) < /dev/null', line)
+            if command:
+                self.host.wait()
+                out = self.host.answer(_decoded(command.group(1)))
+                self.buffer += (out and out + '\n' or '') + '%s 0 0.0 0.0\n' % token.group(1)
+            else:
+                self.buffer += '%s 0\n' % token.group(1)
+
+    def recv(self, size):
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def makefile(self, mode):
+        return self
+
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+    def recv_exit_status(self):
+        self.host.wait()
+        return 0
+
+    def set_combine_stderr(self, combine):
+        pass
+
+    def settimeout(self, timeout):
+        pass
+
+    def shutdown_write(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _Client(object):
+    def __init__(self, host):
+        self.host = host
+
+    def get_transport(self):
+        return self
+
+    def open_session(self):
+        return _Channel(self.host)
+
+    def open_channel(self, kind, address, origin):
+        return _Channel(self.host, address[1])
+
+
+class _Connections(dict):
+    def __init__(self, host):
+        dict.__init__(self)
+        self.host = host
+
+    def __missing__(self, host_string):
+        self[host_string] = _Client(self.host)
+        return self[host_string]
+
+
+def _project(path):
+    """
+    Writes the local files the tasks read into path
+    """
+    from glue.bottle import env
+    files = {
+        'conf/.bash_profile_source': 'export WORKON_HOME=/sites/.virtualenvs\n',
+        '%s/conf/env/secrets.cfg' % env.project_name: '[secrets]\n',
+        'requirements/%s.pip' % env.flavor: 'Django==1.4.22\n',
+        'conf/supervisord/%s.conf' % env.flavor: '[program:x]\n',
+        'conf/nginx/%s.conf' % env.flavor: 'server {}\n',
+        'etc/logrotate/%s.conf' % env.flavor: '/sites/logs/*.log {}\n',
+        'vendors/virtualenv/node_modules/pkg/index.js': 'module.exports = 1;\n',
+    }
+    for i in range(MEDIA_FILES):
+        files['public/media/uploads/%04d.jpg' % i] = 'x' * 1024
+    for name, content in files.items():
+        if not os.path.isdir(os.path.dirname(os.path.join(path, name))):
+            os.makedirs(os.path.dirname(os.path.join(path, name)))
+        with open(os.path.join(path, name), 'w') as f:
+            f.write(content)
+
+
+def _media_listing(command):
+    """
+    The host's side of the syncmedia scenario: the same files, with
+    MEDIA_CHANGED of them changed and as many only on the host
+    """
+    lines = []
+    for i in range(MEDIA_FILES):
+        path = os.path.join('public', 'media', 'uploads', '%04d.jpg' % i)
+        stat = os.stat(path)
+        size = i < MEDIA_CHANGED and 2048 or stat.st_size
+        lines.append('uploads/%04d.jpg\t%d\t%d.0' % (i, size, stat.st_mtime))
+    for i in range(MEDIA_CHANGED):
+        lines.append('uploads/remote-%04d.jpg\t1024\t%d.0' % (i, time.time()))
+    return '\n'.join(lines)
+
+
+def _settings_module():
+    """
+    Makes glue.settings importable: the project's settings if
+    DJANGO_SETTINGS_MODULE is set, a stand-in project otherwise
+    """
+    if not os.environ.get('DJANGO_SETTINGS_MODULE'):
+        sys.modules['benchproject'] = types.ModuleType('benchproject')
+        sys.modules['benchproject'].SECRET_KEY = 'benchmark'
+        os.environ['DJANGO_SETTINGS_MODULE'] = 'benchproject'
+    from glue.settings import GLUE_SETTINGS
+    return GLUE_SETTINGS
+
+
+def _setup(flavor):
+    """
+    Sets env up like the generated fabfile's prod()/staging() do, for one
+    fake host
+    """
+    from glue import bottle
+    settings = _settings_module()
+    flavor_settings = settings[flavor]
+    env = bottle.env
+    env.flavor = flavor
+    env.procname = flavor_settings['process_name']
+    env.user = settings['ssh_user']
+    env.port = settings['ssh_port']
+    env.hosts = ['bench@fakehost:22']
+    env.host_string, env.host = env.hosts[0], 'fakehost'
+    env.venv_root = flavor_settings['venv_root']
+    env.venv_name = flavor_settings['venv_name']
+    env.venv_path = os.path.join(env.venv_root, env.venv_name)
+    env.path = bottle._project_path(flavor, settings)
+    env.repo = flavor_settings['repo']
+    env.branch = flavor_settings['git_branch']
+    env.project_user = settings['project_name']
+    env.project_group = settings['project_group']
+    env.memcached_enabled = True
+    env.redis_enabled = True
+    env.redis_key = flavor_settings['redis_key'] or 'bench:generation'
+    env.memcached_gen_key = flavor_settings['memcached_gen_key'] or 'bench:generation'
+    env.db_user = flavor_settings['db_user']
+    env.db_name = flavor_settings['db_name']
+    env.db_pass = flavor_settings['db_pass']
+    env.public_path = os.path.join(env.path, flavor_settings['public_path'])
+    env.media_path = os.path.join(env.public_path, flavor_settings['media_path'])
+    env.project_name = settings['project_name']
+    # nothing of the benchmark's own runs should be kept
+    env.trace_file = env.history_file = ''
+    env.abort_exception = RuntimeError
+
+
+def _install(host):
+    """
+    Points glue.bottle at the fake host
+    """
+    from glue import bottle
+    bottle.run, bottle.sudo, bottle.put, bottle.local = host.run, host.sudo, host.put, host.local
+    bottle.connections = _Connections(host)
+    bottle._rsync_parallel = host.rsync
+    bottle._fabric_exists = host.exists
+    bottle._confirmtask = lambda *args, **kwargs: None
+
+
+def _scenarios():
+    from glue import bottle
+    return {
+        'update': lambda: bottle.update(),
+        'bootstrap': lambda: bottle.bootstrap(),
+        'syncmedia': lambda: bottle.syncmedia(),
+        'fixprojectperms': lambda: bottle.fixprojectperms(),
+    }
+
+
+def measure(name, latency=0.0):
+    """
+    Runs the named scenario against a fresh fake host in a scratch
+    project. Returns {'round_trips', 'bytes', 'seconds', 'error'}
+    """
+    from glue import bottle
+    host = FakeHost(latency, [(r'find .* -printf', _media_listing)])
+    _install(host)
+    for cache in (bottle._FACTS, bottle._SESSIONS, bottle._CACHE_CLIENTS):
+        cache.clear()
+    del bottle._TRACE[:]
+    bottle._REVISIONS.clear()
+    # counted from here rather than reset, which would report at exit again
+    round_trips = bottle._STATS['round_trips']
+    cwd, scratch = os.getcwd(), tempfile.mkdtemp(prefix='glue-bench-')
+    error = None
+    try:
+        os.chdir(scratch)
+        _project(scratch)
+        started = time.time()
+        try:
+            _scenarios()[name]()
+        except (Exception, SystemExit) as e:
+            error = '%s: %s' % (e.__class__.__name__, e)
+        seconds = time.time() - started
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch)
+    return {
+        'round_trips': bottle._STATS['round_trips'] - round_trips,
+        'bytes': sum(e['bytes'] for e in bottle._TRACE
+                     if e['kind'] != 'task' and not e.get('batch')),
+        'seconds': round(seconds, 3),
+        'error': error,
+    }
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='python -m glue.benchmark [options]')
+    parser.add_option('--tasks', default=','.join(sorted(BUDGETS)),
+                      help='comma separated scenarios to run')
+    parser.add_option('--latency', type='float', default=0.01,
+                      help='seconds the fake host takes per round trip')
+    parser.add_option('--flavor', default='prod')
+    parser.add_option('--budgets', help='json file with budgets to check against')
+    parser.add_option('--record', help='write the measurements, plus 10%, as budgets here')
+    parser.add_option('--verbose', action='store_true', help="show the tasks' own output")
+    options, _ = parser.parse_args(argv)
+
+    from fabric.api import hide, settings
+    budgets = dict(BUDGETS)
+    if options.budgets:
+        with open(options.budgets) as f:
+            budgets.update(json.load(f))
+    _setup(options.flavor)
+    results, failed = {}, False
+    for name in options.tasks.split(','):
+        stdout = sys.stdout
+        if not options.verbose:
+            sys.stdout = open(os.devnull, 'w')
+        try:
+            with settings(hide('everything')):
+                results[name] = result = measure(name, options.latency)
+        finally:
+            sys.stdout = stdout
+        over = [key for key in ('round_trips', 'bytes', 'seconds')
+                if key in budgets.get(name, {}) and result[key] > budgets[name][key]]
+        failed = failed or bool(over or result['error'])
+        print('%-16s %5d round trips %9d bytes %7.2fs  %s' % (
+            name, result['round_trips'], result['bytes'], result['seconds'],
+            result['error'] or (over and 'OVER BUDGET: %s' % ', '.join(
+                '%s %s > %s' % (key, result[key], budgets[name][key]) for key in over)) or 'ok'))
+    if options.record:
+        with open(options.record, 'w') as f:
+            json.dump(dict((name, {
+                'round_trips': int(r['round_trips'] * 1.1) + 1,
+                'bytes': int(r['bytes'] * 1.1) + 1,
+                'seconds': round(r['seconds'] * 1.1 + 0.1, 2),
+            }) for name, r in results.items()), f, indent=4, sort_keys=True)
+    return failed and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,39 @@
 #!/usr/bin/env python
+import atexit
+import base64
+import cPickle
+import difflib
+import functools
+import hashlib
+import json
+import multiprocessing
 import os
 import random
+import re
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import urllib2
+import zlib
+from contextlib import contextmanager as _contextmanager
+from datetime import datetime
+from Queue import Empty as _Empty, Queue as _Queue
+from StringIO import StringIO as _StringIO
 
 from fabric.api import *
-from fabric.contrib.files import exists as _exists
+from fabric.contrib.files import exists as _fabric_exists
 from fabric.context_managers import settings as _settings, shell_env
 from fabric.colors import red, green, yellow, cyan
-from fabric.operations import prompt
-from fabric.utils import abort
+from fabric.operations import prompt, _AttributeString, _prefix_commands, \
+    _prefix_env_vars, _shell_wrap
+from fabric.state import connections
+from fabric.utils import abort, error as _error
+
+from glue import cache
+from glue import logstats as _logstats
 
 
 VERSION_NUMBER = '1.0.1'
@@ -17,6 +43,1041 @@ def _get_version():
     return VERSION_NUMBER
 
 
+def _conf(key, default=None):
+    """
+    Looks up a glue setting. `fab --set key=value` wins, then the current
+    flavor's GLUE_SETTINGS, then the top level of GLUE_SETTINGS
+    """
+    if key in env:
+        return env[key]
+    return _setting(key, default)
+
+
+def _setting(key, default=None):
+    """
+    Looks up a glue setting in GLUE_SETTINGS only, for keys that env holds
+    in another form (e.g. public_path, which env has as an absolute path)
+    """
+    from glue.settings import GLUE_SETTINGS
+    # multi() runs tasks for other projects, with their settings in env
+    GLUE_SETTINGS = env.get('glue_settings') or GLUE_SETTINGS
+    flavor_settings = GLUE_SETTINGS.get(env.get('flavor'), {})
+    if key in flavor_settings:
+        return flavor_settings[key]
+    return GLUE_SETTINGS.get(key, default)
+
+
+# counters for the whole fab run, reported when it exits
+_STATS = {
+    'hosts': set(),
+    'round_trips': 0,
+    'sessions': 0,
+    'reloads': [],
+}
+
+
+def _round_trip():
+    """
+    Counts a request/response exchange with the current host
+    """
+    if not _STATS['round_trips']:
+        atexit.register(_report_connections)
+    _STATS['hosts'].add(env.host_string)
+    _STATS['round_trips'] += 1
+
+
+def _report_connections():
+    """
+    Prints how many connections and round trips the run used, and how
+    long each graceful reload took
+    """
+    print(cyan('-- connections // %d ssh connection(s), %d warm shell(s), %d round trip(s)' % (
+        len(_STATS['hosts']), _STATS['sessions'], _STATS['round_trips'])))
+    for host, mode, seconds in _STATS['reloads']:
+        print(cyan('-- reloads // %s: new workers answering %.1fs after the %s' % (host, seconds, mode)))
+
+
+# what the run did, one event per task, remote command, upload or stream.
+# Written out at exit (trace_file, history_file) and summed up by _success()
+_TRACE = []
+_MAIN_PID = os.getpid()
+
+
+@_contextmanager
+def _span(kind, name, **fields):
+    """
+    Records the wall time of the block as a trace event. The block can add
+    to the yielded event: remote (seconds on the host), bytes, status
+    """
+    event = {'kind': kind, 'name': name, 'host': env.host_string, 'pid': os.getpid(),
+             'start': time.time(), 'remote': None, 'bytes': 0, 'status': 0}
+    event.update(fields)
+    try:
+        yield event
+    except BaseException:
+        event['status'] = event['status'] or 'failed'
+        raise
+    finally:
+        event['seconds'] = time.time() - event['start']
+        _TRACE.append(event)
+
+
+def _measure(event, command, result):
+    """
+    Fills a command's event from its result
+    """
+    event['bytes'] = len(command) + len(result or '')
+    event['status'] = getattr(result, 'return_code', 0)
+    event['remote'] = getattr(result, 'remote_seconds', None)
+
+
+def _traced(func):
+    """
+    Wraps a glue task so each call is recorded as a task event
+    """
+    @functools.wraps(func)
+    def task(*args, **kwargs):
+        with _span('task', func.__name__):
+            return func(*args, **kwargs)
+    return task
+
+
+def _merge_trace(result):
+    """
+    Takes over the trace events of a _timed_call() that ran in another
+    process
+    """
+    if result.get('pid') != os.getpid():
+        _TRACE.extend(result.get('trace', ()))
+
+
+def _trace_summary():
+    """
+    Prints the time spent per task and the slowest remote commands
+    """
+    tasks = {}
+    for event in _TRACE:
+        if event['kind'] == 'task':
+            count, seconds = tasks.get(event['name'], (0, 0.0))
+            tasks[event['name']] = (count + 1, seconds + event['seconds'])
+    commands = [e for e in _TRACE if e['kind'] != 'task']
+    if not tasks and not commands:
+        return
+    print(cyan('-- trace // %-28s %5s %9s' % ('task', 'calls', 'seconds')))
+    for name, (count, seconds) in sorted(tasks.items(), key=lambda t: -t[1][1]):
+        print('   %-28s %5d %9.2f' % (name, count, seconds))
+    print(cyan('-- trace // %d remote operations, %.1fs, %.1f kB; slowest:' % (
+        len(commands), sum(e['seconds'] for e in commands),
+        sum(e['bytes'] for e in commands) / 1024.0)))
+    for event in sorted(commands, key=lambda e: -e['seconds'])[:5]:
+        remote = event['remote'] is not None and ' (%.2fs on host)' % event['remote'] or ''
+        print('   %7.2fs%s %s %s: %s' % (event['seconds'], remote, event['host'],
+                                      event['kind'], event['name'][:80]))
+
+
+def _write_trace():
+    """
+    Writes the trace to trace_file (trace_format: chrome or json) and adds
+    the run to history_file
+    """
+    if os.getpid() != _MAIN_PID or not _TRACE:
+        return
+    trace_file = _conf('trace_file', '')
+    if trace_file:
+        if _conf('trace_format', 'chrome') == 'chrome':
+            hosts = sorted(set(e['host'] for e in _TRACE))
+            data = {'traceEvents': [{
+                'name': e['name'][:200], 'cat': e['kind'], 'ph': 'X',
+                'ts': int(e['start'] * 1e6), 'dur': int(e['seconds'] * 1e6),
+                'pid': hosts.index(e['host']), 'tid': e['pid'],
+                'args': {'host': e['host'], 'remote': e['remote'],
+                         'bytes': e['bytes'], 'status': e['status']},
+            } for e in _TRACE] + [{
+                'name': 'process_name', 'ph': 'M', 'pid': i, 'args': {'name': host or 'local'},
+            } for i, host in enumerate(hosts)]}
+        else:
+            data = _TRACE
+        with open(trace_file, 'w') as f:
+            json.dump(data, f)
+    history_file = _conf('history_file', '')
+    tasks = [e for e in _TRACE if e['kind'] == 'task']
+    if history_file and tasks and _STATS['round_trips']:
+        if not os.path.isdir(os.path.dirname(history_file) or '.'):
+            os.makedirs(os.path.dirname(history_file))
+        seconds = {}
+        for event in tasks:
+            seconds[event['name']] = seconds.get(event['name'], 0) + event['seconds']
+        with open(history_file, 'a') as f:
+            f.write(json.dumps({
+                'at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'command': ' '.join(sys.argv[1:]),
+                'flavor': env.get('flavor'),
+                'revision': ', '.join(sorted(set(_REVISIONS.values()))) or None,
+                'seconds': max(e['start'] + e['seconds'] for e in _TRACE) - min(e['start'] for e in _TRACE),
+                'failed': any(e['status'] for e in tasks),
+                'tasks': seconds,
+                'round_trips': _STATS['round_trips'],
+            }) + '\n')
+
+
+def history(last='10', task=''):
+    """
+    Shows the last runs recorded in history_file, with the time of their
+    slowest tasks, or of task only
+    """
+    history_file = _conf('history_file', '')
+    if not history_file or not os.path.exists(history_file):
+        abort('history: nothing recorded in %s yet' % (history_file or 'history_file'))
+    with open(history_file) as f:
+        runs = [json.loads(line) for line in f if line.strip()][-int(last):]
+    for run in runs:
+        if task:
+            tasks = task in run['tasks'] and '%s %.1fs' % (task, run['tasks'][task]) or '-'
+        else:
+            tasks = ', '.join('%s %.1fs' % t for t in sorted(
+                run['tasks'].items(), key=lambda t: -t[1])[:4])
+        print('%s  %-24s %7.1fs %-6s %s' % (run['at'], run['command'][:24], run['seconds'],
+                                          run['failed'] and 'failed' or 'ok', tasks))
+
+
+def _ssh_command():
+    """
+    ssh command line for local tools like rsync. Shares one master
+    connection per host through ControlMaster, so consecutive calls
+    skip the handshake
+    """
+    return 'ssh -p %s -o ControlMaster=auto -o ControlPath=%s -o ControlPersist=%s' % (
+        env.port, _conf('ssh_control_path'), _conf('ssh_control_persist'))
+
+
+def _result(command, wrapped, return_code, out):
+    """
+    Wraps output from a batch or session the way run()/sudo() would
+    """
+    result = _AttributeString(out)
+    result.command = command
+    result.real_command = wrapped
+    result.return_code = return_code
+    result.failed = return_code != 0
+    result.succeeded = not result.failed
+    result.stderr = ''
+    return result
+
+
+def _remote_seconds(started=None, finished=None):
+    """
+    Seconds between two `date +%s.%N` stamps from the host, or None
+    """
+    try:
+        return float(finished) - float(started)
+    except (TypeError, ValueError):
+        return None
+
+
+def _check_result(result, use_sudo, warn_only):
+    """
+    Aborts or warns on a failed _result(), according to warn_only
+    """
+    if result.failed:
+        with _settings(warn_only=warn_only):
+            _error('%s() received nonzero return code %s while executing!'
+                  '\n\nRequested: %s\nExecuted: %s' % (
+                      use_sudo and 'sudo' or 'run', result.return_code,
+                      result.command, result.real_command), stdout=result)
+    return result
+
+
+# warm shells, keyed by (host_string, user). None if one could not be opened
+_SESSIONS = {}
+
+
+class _Session(object):
+    """
+    A shell kept open on the host for the rest of the run, so commands
+    for user don't pay for a new channel, sudo and login shell each time.
+    Commands run in a subshell, so cd() and exports don't leak between them
+    """
+    def __init__(self, user):
+        self.user = user
+        self.token = '__glue_%08x' % random.getrandbits(32)
+        self.buffer = ''
+        transport = connections[env.host_string].get_transport()
+        self.channel = transport.open_session()
+        self.channel.set_combine_stderr(True)
+        if env.command_timeout:
+            self.channel.settimeout(env.command_timeout)
+        self.channel.exec_command('sudo -n -H -u "%s" %s' % (
+            user, env.shell.rsplit(' -c', 1)[0]))
+        self.channel.sendall("printf '%s 0\\n'\n" % self.token)
+        self.read(echo=False)
+
+    def read(self, echo=True):
+        """
+        Reads output up to the next marker, returning (output, return_code,
+        seconds the command took on the host or None)
+        """
+        lines = []
+        while True:
+            while '\n' not in self.buffer:
+                data = self.channel.recv(4096)
+                if not data:
+                    raise EOFError('warm shell for %s closed: %s' % (
+                        self.user, '\n'.join(lines) or self.buffer))
+                self.buffer += data
+            line, self.buffer = self.buffer.split('\n', 1)
+            line = line.rstrip('\r')
+            if self.token in line:
+                line, marker = line.split(self.token, 1)
+                if line:
+                    lines.append(line)
+                    if echo and output.stdout:
+                        print('[%s] out: %s' % (env.host_string, line))
+                fields = marker.split()
+                return '\n'.join(lines), int(fields[0]), _remote_seconds(*fields[1:])
+            lines.append(line)
+            if echo and output.stdout:
+                print('[%s] out: %s' % (env.host_string, line))
+
+    def execute(self, command):
+        """
+        Runs command in the shell, honoring cd()/prefix()/shell_env()
+        """
+        _round_trip()
+        wrapped = _prefix_env_vars(_prefix_commands(command, 'remote'))
+        if output.running:
+            print('[%s] sudo: %s' % (env.host_string, command))
+        self.channel.sendall("s=$(date +%%s.%%N); ( %s ) < /dev/null 2>&1; rc=$?; "
+                             "printf '%s %%d %%s %%s\\n' $rc $s $(date +%%s.%%N)\n" % (
+                                 wrapped, self.token))
+        out, return_code, remote = self.read()
+        result = _result(command, wrapped, return_code, out)
+        result.remote_seconds = remote
+        return _check_result(result, True, env.warn_only)
+
+    def close(self):
+        self.channel.close()
+
+
+def _session(user):
+    """
+    Returns the warm shell for user on the current host, opening it on
+    first use. Only project_user gets one, and only with warm_shell on
+    """
+    if not user or user != env.get('project_user') or not _conf('warm_shell', True):
+        return None
+    key = (env.host_string, user)
+    if key not in _SESSIONS:
+        try:
+            _round_trip()
+            _SESSIONS[key] = _Session(user)
+            _STATS['sessions'] += 1
+        except Exception as e:
+            print(yellow('-- session // no warm shell for %s (%s), using sudo()' % (user, e)))
+            _SESSIONS[key] = None
+    return _SESSIONS[key]
+
+
+# the active _batch(), if any. nested batches join the outermost one
+_BATCHES = []
+
+
+class _Batch(object):
+    """
+    Collects _run()/_sudo() calls and sends them to the host as one
+    remote script. Every command gets its own exit code and output back.
+    """
+    def __init__(self):
+        self.commands = []
+        self.results = []
+
+    def queue(self, command, user=None, use_sudo=False):
+        """
+        Queues command with the cd()/prefix()/shell_env() and warn_only
+        state that is active right now
+        """
+        self.commands.append({
+            'command': command,
+            'wrapped': _prefix_env_vars(_prefix_commands(command, 'remote')),
+            'user': user,
+            'sudo': use_sudo,
+            'warn_only': env.warn_only,
+        })
+
+    def script(self, commands, token):
+        """
+        Builds the remote script. Each command is fenced by token markers,
+        and the script stops at the first failure unless warn_only was set
+        when the command was queued
+        """
+        as_root = any(c['sudo'] for c in commands)
+        lines = []
+        for i, c in enumerate(commands):
+            if c['sudo'] and c['user']:
+                prefix = 'sudo -H -u "%s"' % c['user']
+            elif as_root and not c['sudo']:
+                prefix = 'sudo -H -u "%s"' % env.user
+            else:
+                prefix = None
+            lines.append("printf '\\n%s %d %%s\\n' $(date +%%s.%%N)" % (token, i))
+            lines.append('%s < /dev/null 2>&1' % _shell_wrap(
+                c['wrapped'], True, sudo_prefix=prefix))
+            lines.append('rc=$?')
+            lines.append("printf '\\n%s %d %%d %%s\\n' $rc $(date +%%s.%%N)" % (token, i))
+            if not c['warn_only']:
+                lines.append('[ $rc -eq 0 ] || exit $rc')
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        """
+        Sends everything queued so far as a single round trip
+        """
+        if not self.commands:
+            return []
+        commands, self.commands = self.commands, []
+        token = '__glue_%08x' % random.getrandbits(32)
+        runner = _shell_script(self.script(commands, token))
+        print(cyan('-- batch // sending %d commands in one go' % len(commands)))
+        _round_trip()
+        with _span('batch', '%d commands' % len(commands)) as event:
+            with _settings(hide('running', 'stdout'), warn_only=True):
+                if any(c['sudo'] for c in commands):
+                    raw = sudo(runner)
+                else:
+                    raw = run(runner)
+            _measure(event, runner, raw)
+
+        outputs = _split_batch_output(raw, token)
+        results = []
+        for i, c in enumerate(commands):
+            if i not in outputs:
+                break
+            return_code, out, remote = outputs[i]
+            if output.running:
+                print('[%s] %s: %s' % (
+                    env.host_string, c['sudo'] and 'sudo' or 'run', c['command']))
+            if output.stdout and out:
+                for line in out.splitlines():
+                    print('[%s] out: %s' % (env.host_string, line))
+            result = _result(c['command'], c['wrapped'], return_code, out)
+            result.remote_seconds = remote
+            _TRACE.append({'kind': 'command', 'name': c['command'], 'host': env.host_string,
+                           'pid': os.getpid(), 'start': event['start'], 'seconds': remote or 0.0,
+                           'remote': remote, 'bytes': len(c['command']) + len(out),
+                           'status': return_code, 'batch': True})
+            results.append(result)
+            self.results.append(result)
+            _check_result(result, c['sudo'], c['warn_only'])
+
+        if len(results) < len(commands) and raw.failed:
+            # the script itself never got to the command, e.g. sudo failed
+            _error('batch: remote script failed before running "%s"' % (
+                commands[len(results)]['command']), stdout=raw)
+        return results
+
+
+def _shell_script(script):
+    """
+    A one line command that runs a multi line shell script on the host,
+    without any quoting trouble
+    """
+    return 'echo %s | base64 -d | /bin/sh' % base64.b64encode(script)
+
+
+def _split_batch_output(raw, token):
+    """
+    Splits the combined output of a batch script into
+    {index: (return_code, output, seconds on the host)}
+    """
+    outputs = {}
+    current = None
+    lines = []
+    for line in raw.replace('\r', '').split('\n'):
+        if line.startswith(token):
+            parts = line.split()
+            if len(parts) == 3:
+                current, started = int(parts[1]), parts[2]
+                lines = []
+            elif current is not None:
+                outputs[current] = (int(parts[2]), '\n'.join(lines).strip('\n'),
+                                    _remote_seconds(started, parts[3]))
+                current = None
+        elif current is not None:
+            lines.append(line)
+    return outputs
+
+
+@_contextmanager
+def _batch():
+    """
+    Queues _run() and _sudo() calls made inside the block and sends them
+    to the host as one script when the block exits. Queued calls return
+    None; results are available on the yielded batch afterwards.
+
+        with _batch():
+            _setowner(path)
+            _setperms('660', path)
+    """
+    if _BATCHES:
+        yield _BATCHES[0]
+        return
+    current = _Batch()
+    _BATCHES.append(current)
+    try:
+        yield current
+    finally:
+        _BATCHES.pop()
+    current.flush()
+
+
+def _flush():
+    """
+    Sends anything queued in the active _batch() right away. Called before
+    operations that need the host to be up to date, like _exists() and _put()
+    """
+    if _BATCHES:
+        _BATCHES[0].flush()
+
+
+def _sudo(command, user=None):
+    """
+    sudo() that joins the active _batch(), if any
+    """
+    _forget(command)
+    if _BATCHES:
+        return _BATCHES[0].queue(command, user=user, use_sudo=True)
+    session = _session(user)
+    with _span('command', command, user=user) as event:
+        if session:
+            result = session.execute(command)
+        else:
+            _round_trip()
+            result = sudo(command, user=user)
+        _measure(event, command, result)
+    return result
+
+
+def _run(command):
+    """
+    run() that joins the active _batch(), if any
+    """
+    _forget(command)
+    if _BATCHES:
+        return _BATCHES[0].queue(command)
+    with _span('command', command) as event:
+        _round_trip()
+        result = run(command)
+        _measure(event, command, result)
+    return result
+
+
+# what this run knows about the hosts, keyed by (host_string, item) where
+# item is a path, 'user:<name>', 'group:<name>' or 'state:<dir>'. _sudo()
+# and _run() drop what their commands might change, see _forget()
+_FACTS = {}
+
+_FACT_TESTS = {
+    'path': 'test -e "%s"',
+    'user': 'id -u "%s" > /dev/null 2>&1',
+    'group': 'getent group "%s" > /dev/null',
+}
+
+
+def _probes(*items):
+    """
+    Declares the paths (and 'user:<name>', 'group:<name>') a task checks
+    on the host, interpolated with env, so _gather_facts() can look them
+    all up in one go
+    """
+    def decorator(func):
+        func.glue_probes = items
+        return func
+    return decorator
+
+
+def _gather_facts(names):
+    """
+    Looks up everything the named tasks _probes() for in one remote call
+    """
+    items = []
+    for name in names:
+        for item in getattr(globals()[name], 'glue_probes', ()):
+            item = item % env
+            if item not in items and (env.host_string, item) not in _FACTS:
+                items.append(item)
+    if not items:
+        return
+    checks = []
+    for item in items:
+        kind, target = re.match(r'(?:(user|group):)?(.*)', item).groups()
+        checks.append('%s && echo "1 %s" || echo "0 %s"' % (
+            _FACT_TESTS[kind or 'path'] % target, item, item))
+    print(cyan('-- facts // looking up %d path(s) and user(s)' % len(items)))
+    with _settings(hide('running', 'stdout')):
+        found = _sudo('; '.join(checks))
+    for line in found.splitlines():
+        if re.match(r'[01] ', line):
+            _FACTS[(env.host_string, line[2:].rstrip())] = line[0] == '1'
+
+
+def _fact(item, value):
+    """
+    Records what a task just did to item on the current host
+    """
+    _FACTS[(env.host_string, item)] = value
+
+
+# commands that only read from the host, so leave _FACTS as they are
+_READ_ONLY = re.compile(r'^(cat|ls|stat|test|id|getent|readlink|head|tail|md5sum|du|df|ps|pgrep|'
+                        r'git (rev-parse|ls-remote|log|show|status))\s(?:(?!\$\()[^;&|>`])*$')
+
+
+def _forget(command):
+    """
+    Drops the facts command might change: all paths on the host unless it
+    only reads, users and groups when it adds, removes or modifies them,
+    and the state dir when it mentions it
+    """
+    if _READ_ONLY.match(command.replace('2>/dev/null', '').strip()):
+        return
+    for key in [k for k in _FACTS if k[0] == env.host_string]:
+        kind, _, name = key[1].partition(':')
+        if kind in ('user', 'group'):
+            if not re.search(r'\b(user|group)(add|del|mod)\b', command):
+                continue
+        elif kind == 'state' and name not in command:
+            continue
+        del _FACTS[key]
+
+
+def _exists(path, use_sudo=False, verbose=False):
+    """
+    fabric's exists(), answered from _FACTS when possible, and otherwise
+    sent after anything queued in the active _batch()
+    """
+    key = (env.host_string, path)
+    if key not in _FACTS:
+        _flush()
+        _round_trip()
+        _FACTS[key] = _fabric_exists(path, use_sudo=use_sudo, verbose=verbose)
+    return _FACTS[key]
+
+
+def _user_exists(user):
+    """
+    Whether user exists on the host, answered from _FACTS when possible
+    """
+    key = (env.host_string, 'user:%s' % user)
+    if key not in _FACTS:
+        with _settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+            _FACTS[key] = _sudo('id %s' % user).succeeded
+    return _FACTS[key]
+
+
+def _put(local_path, remote_path, use_sudo=False):
+    """
+    put(), sent after anything queued in the active _batch(). Directories
+    go through _put_tree(), into remote_path/<name> like put() does
+    """
+    if os.path.isdir(local_path):
+        if remote_path.endswith('/'):
+            remote_path = os.path.join(remote_path, os.path.basename(local_path.rstrip('/')))
+        return _put_tree(local_path, remote_path, owner=False)
+    _forget(remote_path)
+    _flush()
+    with _span('put', remote_path, bytes=os.path.getsize(local_path)):
+        _round_trip()
+        return put(local_path, remote_path, use_sudo=use_sudo)
+
+
+def _tree_hash(local_path, mode):
+    """
+    Hashes the paths, modes and contents of the files below local_path
+    """
+    digest = hashlib.sha1(str(mode))
+    for directory, directories, files in os.walk(local_path):
+        directories.sort()
+        for name in sorted(files + directories):
+            path = os.path.join(directory, name)
+            digest.update('%s %o\0' % (os.path.relpath(path, local_path), os.lstat(path).st_mode))
+            if os.path.islink(path):
+                digest.update(os.readlink(path))
+            elif os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1 << 20), ''):
+                        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _put_tree(local_path, remote_path, mode=None, owner=True, check=True):
+    """
+    Uploads the directory local_path to remote_path as one gzipped tar
+    stream, extracted by root with project_user:project_group as owner
+    (unless owner is False) and mode (octal string, x added to directories)
+    set on the way. With check, nothing is sent while the tree matches
+    what was last uploaded there, and remote_path is still there. Returns
+    whether it uploaded
+    """
+    state = _state_path('tree-%s' % hashlib.md5(remote_path).hexdigest()[:10])
+    tree = _tree_hash(local_path, mode)
+    if check:
+        with _settings(hide('stdout'), warn_only=True):
+            # a recreated target (e.g. a new virtualenv) needs it again
+            if _sudo('[ -d "%s" ] && cat %s 2>/dev/null' % (remote_path, state)).strip() == tree:
+                print(green('-- put // %s unchanged, skipping' % remote_path))
+                return False
+    _forget(remote_path)
+    _flush()
+    _round_trip()
+    file_mode = mode and int(mode, 8)
+    dir_mode = file_mode and file_mode | (file_mode & 0o444) >> 2
+
+    def fix(info):
+        event['bytes'] += info.size
+        if owner:
+            info.uname, info.gname = env.project_user, env.project_group
+            info.uid = info.gid = 0
+        if file_mode and not info.issym():
+            info.mode = info.isdir() and dir_mode or file_mode
+        return info
+
+    started, count = time.time(), 0
+    with _span('put', remote_path) as event:
+        channel = connections[env.host_string].get_transport().open_session()
+        channel.set_combine_stderr(True)
+        channel.exec_command('sudo -n /bin/sh -c \'mkdir -p "%s" && tar -xzf - -C "%s" %s && %secho %s > "%s"\'' % (
+            remote_path, remote_path, not owner and '--no-same-owner' or '',
+            _state_dir_command() or 'mkdir -p "%s" && ' % os.path.dirname(state), tree, state))
+        stream = channel.makefile('wb')
+        with tarfile.open(fileobj=stream, mode='w|gz') as tar:
+            for directory, directories, names in os.walk(local_path):
+                # os.walk lists links to directories with the directories
+                links = [name for name in directories if os.path.islink(os.path.join(directory, name))]
+                for path in [directory] + [os.path.join(directory, name) for name in names + links]:
+                    tar.add(path, os.path.relpath(path, local_path), recursive=False, filter=fix)
+                    count += 1
+        stream.flush()
+        channel.shutdown_write()
+        if channel.recv_exit_status():
+            abort('put: extracting into %s failed: %s' % (remote_path, channel.recv(4096).strip()))
+    print(green('-- put // %d entries into %s in %.1fs' % (
+        count, remote_path, time.time() - started)))
+    return True
+
+
+def _requires(*names, **options):
+    """
+    Declares the glue tasks that have to run before the decorated task
+    when both are part of a _pipeline(). foreground=True keeps the task
+    out of concurrent waves, for tasks that prompt
+    """
+    def decorator(func):
+        func.glue_requires = names
+        func.glue_foreground = options.get('foreground', False)
+        return func
+    return decorator
+
+
+def _inputs(*items):
+    """
+    Declares what a task's result depends on, for checkpointed pipelines.
+    Items are interpolated with env. A local file or directory stands for
+    its contents, a callable for what it returns, anything else for itself
+    """
+    def decorator(func):
+        func.glue_inputs = items
+        return func
+    return decorator
+
+
+def _fingerprint(name):
+    """
+    Hashes the _inputs() of the named task
+    """
+    digest = hashlib.sha1(name)
+    for item in getattr(globals()[name], 'glue_inputs', ()):
+        item = callable(item) and item() or item % env
+        digest.update('\0%s\0' % item)
+        if os.path.isdir(item):
+            for root, dirs, files in os.walk(item):
+                dirs.sort()
+                for filename in sorted(files):
+                    stat = os.stat(os.path.join(root, filename))
+                    digest.update('%s %s %s\n' % (
+                        os.path.join(root, filename), stat.st_size, int(stat.st_mtime)))
+        elif os.path.isfile(item):
+            with open(item, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+# the revision each host deploys, by host_string
+_REVISIONS = {}
+
+
+def _revision_command():
+    """
+    Prints the sha of the branch in the repository the host pulls from
+    """
+    return ('echo "glue-revision $(git -c safe.directory="*" ls-remote "file:///code/git/%s" "%s" '
+            '2>/dev/null | head -n 1 | cut -f 1)"' % (
+                env.repo, env.get('branch') and 'refs/heads/%s' % env.branch or 'HEAD'))
+
+
+def _note_revision(output):
+    """
+    Keeps the sha _revision_command() printed for the current host, or the
+    local HEAD when the host couldn't tell
+    """
+    sha = ''.join(l.split()[1] for l in output.splitlines()
+                  if l.startswith('glue-revision ') and len(l.split()) > 1)
+    if not sha:
+        with _settings(hide('everything'), warn_only=True):
+            sha = local('git rev-parse HEAD', capture=True).strip()
+    _REVISIONS[env.host_string] = sha
+
+
+def _deployed_revision():
+    """
+    The revision of the branch the host pulls from, which is what gitpull
+    and release deploy, whatever is checked out locally
+    """
+    if env.host_string not in _REVISIONS:
+        with _settings(hide('running', 'stdout'), warn_only=True):
+            _note_revision(_sudo(_revision_command()))
+    return _REVISIONS[env.host_string]
+
+
+def _load_checkpoints(name):
+    """
+    Reads the recorded steps of the named pipeline from the host, and
+    the revision it deploys in the same call
+    """
+    command = 'cat "%s" 2>/dev/null || true' % _state_path('%s.json' % name)
+    if env.host_string not in _REVISIONS:
+        command += '; echo; %s' % _revision_command()
+    with _settings(hide('running', 'stdout')):
+        raw = _sudo(command)
+    if env.host_string not in _REVISIONS:
+        _note_revision(raw)
+    raw = '\n'.join(l for l in raw.splitlines() if not l.startswith('glue-revision')).strip()
+    return raw and json.loads(raw) or {}
+
+
+def _save_checkpoints(name, state):
+    """
+    Writes the recorded steps of the named pipeline to the host, or
+    removes the record if state is empty
+    """
+    path = _state_path('%s.json' % name)
+    with _settings(hide('running', 'stdout')):
+        if state:
+            _sudo('mkdir -p "%s" && echo %s | base64 -d > "%s"' % (
+                os.path.dirname(path), base64.b64encode(json.dumps(state)), path))
+        else:
+            _sudo('rm -f "%s"' % path)
+
+
+def checkpoints(name='bootstrap', clear=''):
+    """
+    Shows the steps recorded for a pipeline (bootstrap or update), and
+    whether their inputs changed since. clear=yes forgets them
+    """
+    require('hosts')
+    state = _load_checkpoints(name)
+    if clear:
+        _save_checkpoints(name, {})
+        print(yellow('-- checkpoints // cleared %d step(s) of %s' % (len(state), name)))
+        return
+    if not state:
+        print(yellow('-- checkpoints // nothing recorded for %s' % name))
+    for step, record in sorted(state.items(), key=lambda i: i[1]['finished']):
+        current = step in globals() and _fingerprint(step) == record['fingerprint']
+        print('-- checkpoints // %-28s %s  %s' % (
+            step, record['finished'], current and 'unchanged' or yellow('inputs changed')))
+
+
+def _waves(names):
+    """
+    Groups names into waves that only depend on earlier waves. Returns
+    the waves and the requirements of each name within names
+    """
+    requires = dict((name, [r for r in getattr(globals()[name], 'glue_requires', ())
+                            if r in names]) for name in names)
+    waves = []
+    done = set()
+    while len(done) < len(names):
+        wave = [n for n in names if n not in done and all(r in done for r in requires[n])]
+        if not wave:
+            abort('pipeline: circular requirements between %s' % ', '.join(
+                n for n in names if n not in done))
+        waves.append(wave)
+        done.update(wave)
+    return waves, requires
+
+
+def _run_step(name, queue):
+    """
+    Runs a pipeline step in its own process, with its own connection
+    """
+    connections.clear()
+    _SESSIONS.clear()
+    _CACHE_CLIENTS.clear()
+    round_trips = _STATS['round_trips']
+    result = _timed_call([name], capture=True)
+    result['round_trips'] = _STATS['round_trips'] - round_trips
+    queue.put((name, result))
+
+
+def _run_wave(wave, jobs):
+    """
+    Runs the steps of a wave, up to jobs of them at a time. Foreground
+    steps run afterwards, one by one, in this process
+    """
+    results = {}
+    foreground = [n for n in wave if getattr(globals()[n], 'glue_foreground', False)]
+    pending = [n for n in wave if n not in foreground]
+    if len(pending) == 1 or jobs < 2:
+        foreground = pending + foreground
+        pending = []
+
+    queue = multiprocessing.Queue()
+    running = {}
+    while pending or running:
+        while pending and len(running) < jobs:
+            name = pending.pop(0)
+            running[name] = multiprocessing.Process(target=_run_step, args=(name, queue))
+            running[name].start()
+        try:
+            name, result = queue.get(timeout=1)
+        except _Empty:
+            for name, process in running.items():
+                if not process.is_alive() and process.exitcode:
+                    results[name] = {'seconds': 0, 'output': '', 'round_trips': 0,
+                                     'error': 'exited with %s' % process.exitcode}
+                    del running[name]
+            continue
+        running.pop(name).join()
+        _STATS['round_trips'] += result['round_trips']
+        print(cyan('-- pipeline // %s finished in %.1fs' % (name, result['seconds'])))
+        if result['output']:
+            print(result['output'].rstrip('\n'))
+        results[name] = result
+        _merge_trace(result)
+
+    for name in foreground:
+        if any(r['error'] for r in results.values()):
+            break
+        results[name] = _timed_call([name])
+    return results
+
+
+def _pipeline(names, jobs=None, checkpoints=None, force='', keep=True):
+    """
+    Runs the named glue tasks in the order their _requires() allow, with
+    independent tasks running concurrently in waves. Prints how long each
+    step took and which chain of steps bounds the total time.
+
+    With checkpoints, finished steps are recorded on the host under that
+    name, and skipped on the next run if their _inputs() are unchanged and
+    the steps they require were skipped too. force is a comma separated
+    list of steps to run anyway, or 'all'. Without keep the record is only
+    kept until the pipeline succeeds
+    """
+    for name in names:
+        if not callable(globals().get(name)):
+            abort('pipeline: no such task %s' % name)
+    jobs = int(jobs or _conf('pipeline_jobs', 4))
+    waves, requires = _waves(list(names))
+    state = checkpoints and _load_checkpoints(checkpoints) or {}
+    recorded = bool(state)
+    forced = force == 'all' and set(names) or set(f for f in force.split(',') if f)
+    fingerprints = dict((n, checkpoints and _fingerprint(n)) for n in names)
+    started = time.time()
+    results = {}
+    try:
+        for i, wave in enumerate(waves):
+            todo = []
+            for name in wave:
+                if checkpoints and name not in forced and \
+                        state.get(name, {}).get('fingerprint') == fingerprints[name] and \
+                        all(results[r].get('skipped') for r in requires[name]):
+                    results[name] = {'seconds': 0, 'error': None, 'skipped': True}
+                else:
+                    todo.append(name)
+            print(cyan('-- pipeline // wave %d: %s' % (i + 1, ', '.join(todo) or 'nothing to do')))
+            if todo:
+                # earlier waves may have run in other processes
+                _FACTS.clear()
+                _gather_facts(todo)
+            for name, result in _run_wave(todo, jobs).items():
+                results[name] = result
+                if not result['error']:
+                    state[name] = {'fingerprint': fingerprints[name],
+                                   'finished': time.strftime('%Y-%m-%d %H:%M:%S')}
+            if any(r['error'] for r in results.values()):
+                break
+    finally:
+        if checkpoints:
+            succeeded = len(results) == len(names) and not any(
+                r['error'] for r in results.values())
+            if keep or not succeeded:
+                _save_checkpoints(checkpoints, state)
+            elif recorded:
+                _save_checkpoints(checkpoints, {})
+    _pipeline_report(waves, requires, results, time.time() - started)
+    failed = [n for n in names if n in results and results[n]['error']]
+    if failed:
+        abort('pipeline: %s failed' % ', '.join(failed))
+
+
+def _pipeline_report(waves, requires, results, elapsed):
+    """
+    Prints step timings and the critical path through the steps
+    """
+    finish = {}
+    previous = {}
+    for wave in waves:
+        for name in wave:
+            if name not in results:
+                continue
+            before = [r for r in requires[name] if r in finish]
+            previous[name] = before and max(before, key=finish.get) or None
+            finish[name] = results[name]['seconds'] + (
+                previous[name] and finish[previous[name]] or 0)
+    path = []
+    name = finish and max(finish, key=finish.get) or None
+    while name:
+        path.insert(0, name)
+        name = previous[name]
+
+    print(cyan('-- pipeline // %-4s %-28s %9s  %s' % ('wave', 'step', 'time', 'status')))
+    for i, wave in enumerate(waves):
+        for name in wave:
+            result = results.get(name)
+            line = '-- pipeline // %-4d %-28s %9s  %s' % (
+                i + 1, (name in path and '* ' or '  ') + name,
+                result and '%.1fs' % result['seconds'] or '-',
+                not result and 'not run' or result['error'] and 'FAILED (%s)' % result['error'] or
+                result.get('skipped') and 'skipped (unchanged)' or 'ok')
+            print(result and result['error'] and red(line) or line)
+    print(cyan('-- pipeline // critical path (*): %s, %.1fs' % (
+        ' > '.join(path), path and finish[path[-1]] or 0)))
+    print(cyan('-- pipeline // %.1fs in total, %.1fs if run one after another' % (
+        elapsed, sum(r['seconds'] for r in results.values()))))
+
+
+def pipeline(*steps, **options):
+    """
+    Runs tasks in dependency order, independent ones concurrently:
+    fab prod pipeline:createdb,nginxcfg,logrotatecfg,jobs=3
+    """
+    require('hosts')
+    for name in steps:
+        if name.startswith('_'):
+            abort('pipeline: no such task %s' % name)
+    _pipeline(list(steps), options.get('jobs'))
+
+
 def showconfig():
     """
     Prints out the config
@@ -27,111 +1088,755 @@ def showconfig():
     pp.pprint(env)
 
 
-def syncdb():
+# prints the migration files in the checkout, the migrations the database
+# has applied (south's or django's history, glue-nohistory with neither),
+# a hash of the files syncdb depends on and the hash the last syncdb saw,
+# and the requirements installed now and when migrate last ran. apps in the
+# virtualenv aren't listed, new requirements make migrate run instead
+_MIGRATION_PLAN_SCRIPT = """
+cd "%(path)s"
+find . -path '*/migrations/[0-9]*.py' | sed 's/^/glue-file /'
+query() { psql -At -F ' ' -d "%(db_name)s" -c "$1" < /dev/null 2>/dev/null; }
+if applied=$(query "SELECT app_name, migration FROM south_migrationhistory"); then
+    echo "$applied" | sed 's/^/glue-applied /'
+elif applied=$(query "SELECT app, name FROM django_migrations"); then
+    echo "$applied" | sed 's/^/glue-applied /'
+else
+    echo "glue-nohistory"
+fi
+requirements=$(cat "%(venv_path)s/.glue-requirements" 2>/dev/null)
+echo "glue-models $({ find . \( -name models.py -o -path '*/models/*.py' -o -name '*settings*.py' \) -print | sort | xargs -r cat; echo "$requirements"; } | md5sum | cut -d ' ' -f 1)"
+echo "glue-synced $(cat "%(state)s" 2>/dev/null)"
+echo "glue-requirements $requirements"
+echo "glue-migrated $(cat "%(migrated)s" 2>/dev/null)"
+"""
+
+# runs migrate with a timestamp on every line of its output, while another
+# loop samples the table locks held in the database every %(interval)s
+_MIGRATE_SCRIPT = """
+cd "%(path)s"
+stamp() { while IFS= read -r line; do echo "$1 $(date +%%s.%%N) $line"; done; }
+sample() {
+    while :; do
+        psql -At -F ' ' -d "%(db_name)s" -c "SELECT c.relname, l.mode FROM pg_locks l
+            JOIN pg_class c ON c.oid = l.relation JOIN pg_database d ON d.oid = l.database
+            WHERE d.datname = current_database() AND l.granted AND l.pid <> pg_backend_pid()
+            AND c.relkind = 'r' AND c.relname NOT LIKE 'pg\\_%%' AND l.mode IN
+            ('ShareLock', 'ShareRowExclusiveLock', 'ExclusiveLock', 'AccessExclusiveLock')" < /dev/null 2>/dev/null | stamp glue-lock
+        sleep %(interval)s
+    done
+}
+sample &
+sampler=$!
+echo "glue-start $(date +%%s.%%N)"
+{
+    FLAVOR=%(flavor)s "%(venv_path)s/bin/python" manage.py migrate --noinput < /dev/null 2>&1
+    rc=$?
+    [ $rc -ne 0 ] || echo "%(requirements)s" > "%(migrated)s"
+    echo "glue-rc $rc"
+} | stamp glue-migrate
+echo "glue-end $(date +%%s.%%N)"
+kill $sampler 2>/dev/null
+wait $sampler 2>/dev/null
+exit 0
+"""
+
+# how migrate announces a migration: south before it runs, django after
+_SOUTH_MIGRATION = re.compile(r'^\s*> (\S+?):(\S+)')
+_DJANGO_MIGRATION = re.compile(r'^\s*Applying (\S+?)\.(\S+?)\.\.\.')
+_LOCK_MODES = ['ShareLock', 'ShareRowExclusiveLock', 'ExclusiveLock', 'AccessExclusiveLock']
+
+
+def _migration_plan():
+    """
+    What the database lacks of the checkout's migrations, in one remote
+    call without django: {'pending': [(app, name)], 'history': whether
+    there is a migration history, 'models', 'synced', 'requirements',
+    'migrated'}
     """
-    Synchronize database models
+    with _settings(hide('running', 'stdout')):
+        result = _sudo(_shell_script(_MIGRATION_PLAN_SCRIPT % {
+            'path': env.path, 'db_name': env.db_name, 'state': _state_path('syncdb'),
+            'venv_path': env.venv_path, 'migrated': _state_path('migrate'),
+        }), user=env.project_user)
+    files, applied = [], set()
+    plan = {'history': True, 'models': None, 'synced': None, 'requirements': None, 'migrated': None}
+    for line in result.splitlines():
+        kind, _, rest = line.partition(' ')
+        if kind == 'glue-file':
+            parts = rest.split('/')
+            files.append((parts[-3], parts[-1][:-len('.py')]))
+        elif kind == 'glue-applied':
+            applied.add(tuple(rest.split(' ', 1)))
+        elif kind == 'glue-nohistory':
+            plan['history'] = False
+        elif kind in ('glue-models', 'glue-synced', 'glue-requirements', 'glue-migrated'):
+            plan[kind[len('glue-'):]] = rest.strip() or None
+    plan['pending'] = sorted(f for f in files if f not in applied)
+    return plan
+
+
+def _migration_timings(lines, started, finished):
+    """
+    [(app, name, start, end)] of the migrations in migrate's timestamped
+    output, which south prints as they start and django as they finish
+    """
+    marks = []
+    for at, line in lines:
+        for pattern, before in ((_SOUTH_MIGRATION, True), (_DJANGO_MIGRATION, False)):
+            match = pattern.match(line)
+            if match:
+                marks.append((at, match.group(1), match.group(2), before))
+    spans = []
+    for i, (at, app, name, before) in enumerate(marks):
+        if before:
+            spans.append((app, name, at, i + 1 < len(marks) and marks[i + 1][0] or finished))
+        else:
+            spans.append((app, name, i and marks[i - 1][0] or started, at))
+    return spans
+
+
+@_requires('installreqs', 'upload_secrets', 'createdb', 'gitpull')
+@_inputs(_deployed_revision)
+def syncdb(full=''):
+    """
+    Synchronize database models. Skipped while the models and settings
+    files and the requirements are unchanged since the last syncdb,
+    unless full=yes
     """
     require('hosts')
+    plan = _migration_plan()
+    if (not full and plan['history'] and plan['requirements'] and plan['models']
+            and plan['models'] == plan['synced']):
+        print(green('-- syncdb // models unchanged since the last syncdb, skipped'))
+        return
     print(cyan('-- syncdb // synchronizing db'))
+    _own_state_dir()
     with cd(env.path):
-        sudo('FLAVOR=%s %s/bin/python manage.py syncdb --noinput' % (
-            env.flavor, env.venv_path), user=env.project_user)
+        _sudo('FLAVOR=%s %s/bin/python manage.py syncdb --noinput && echo %s > "%s"' % (
+            env.flavor, env.venv_path, plan['models'], _state_path('syncdb')), user=env.project_user)
 
 
-def migrate():
+@_requires('syncdb', 'gitpull', 'release')
+@_inputs(_deployed_revision)
+def migrate(full=''):
     """
-    Run database migrations
+    Run database migrations, if any are pending or the requirements changed
+    since the last run (full=yes runs migrate regardless), and report how
+    long each took and the tables it locked
     """
     require('hosts')
-    print(cyan('-- migrate // running db migrations'))
-    with cd(env.path):
-        sudo('FLAVOR=%s %s/bin/python manage.py migrate --noinput' % (
-            env.flavor, env.venv_path), user=env.project_user)
+    plan = _migration_plan()
+    # without a record of the requirements, they may have changed
+    requirements_changed = not plan['requirements'] or plan['requirements'] != plan['migrated']
+    if not full and plan['history'] and not plan['pending'] and not requirements_changed:
+        print(green('-- migrate // no pending migrations, skipped'))
+        return
+    print(cyan('-- migrate // running db migrations: %s' % (
+        ', '.join('%s:%s' % p for p in plan['pending'])
+        or (plan['history'] and requirements_changed and 'requirements changed')
+        or (plan['history'] and 'forced') or 'no history yet')))
+    _own_state_dir()
+    with _settings(hide('stdout')):
+        result = _sudo(_shell_script(_MIGRATE_SCRIPT % {
+            'path': env.path, 'db_name': env.db_name, 'flavor': env.flavor,
+            'venv_path': env.venv_path, 'interval': _conf('migration_lock_interval', 0.5),
+            'requirements': plan['requirements'] or '', 'migrated': _state_path('migrate'),
+        }), user=env.project_user)
+    lines, locks, started, finished, status = [], [], None, None, None
+    for line in result.splitlines():
+        fields = line.split(' ', 2)
+        if fields[0] == 'glue-migrate' and len(fields) > 1:
+            text = len(fields) > 2 and fields[2] or ''
+            if text.startswith('glue-rc '):
+                status = int(text.split()[1])
+            else:
+                lines.append((float(fields[1]), text))
+        elif fields[0] == 'glue-lock' and len(fields) == 3:
+            table, _, mode = fields[2].partition(' ')
+            locks.append((float(fields[1]), table, mode))
+        elif fields[0] == 'glue-start':
+            started = float(fields[1])
+        elif fields[0] == 'glue-end':
+            finished = float(fields[1])
+    if status is None or status:
+        print('\n'.join(text for _, text in lines))
+        abort('migrate: manage.py migrate exited with %s' % (status is None and 'no status' or status))
+
+    for app, name, start, end in _migration_timings(lines, started, finished):
+        held = {}
+        for at, table, mode in locks:
+            if start <= at <= end and _LOCK_MODES.index(mode) >= _LOCK_MODES.index(held.get(table, mode)):
+                held[table] = mode
+        line = '-- migrate // %-48s %7.1fs  %s' % ('%s:%s' % (app, name), end - start, ', '.join(
+            '%s (%s)' % item for item in sorted(held.items())) or 'no table locks seen')
+        print('AccessExclusiveLock' in held.values() and yellow(line) or line)
+    print(green('-- migrate // done in %.1fs' % ((finished or started) - started)))
+
+
+# writes the manifest of the static sources in the checkout to $state.new
+# (blob hash and path of every file under a static/ directory, after a line
+# naming the static root and the installed requirements), and prints the
+# sources that are new or changed since the manifest in $state, the targets
+# more than one source provides, and whether the settings pick a storage
+_STATIC_MANIFEST_SCRIPT = """
+set -e
+cd "%(path)s"
+state="%(state)s"
+mkdir -p "$(dirname "$state")"
+{
+    echo "# $(cat "%(venv_path)s/.glue-requirements" 2>/dev/null) %(root)s"
+    git ls-tree -r HEAD | awk -F '\t' '$2 ~ /(^|\/)static\// { split($1, f, " "); print f[3], $2 }'
+} > "$state.new"
+echo "glue-static total $(($(wc -l < "$state.new") - 1))"
+if [ ! -s "%(venv_path)s/.glue-requirements" ]; then
+    # installreqs hasn't recorded what is installed, packages may have changed
+    echo "glue-static full"
+    exit 0
+fi
+if find . \( -name '*settings*.py' -o -path '*/settings/*.py' \) -print | xargs -r grep -hE '^[[:space:]]*(STATICFILES_STORAGE|STORAGES)[[:space:]=]' | grep -qvE 'FileSystemStorage|\.StaticFilesStorage'; then
+    echo "glue-static storage"
+fi
+tail -n +2 "$state.new" | awk '{
+    n = split(substr($0, index($0, " ") + 1), part, "/")
+    for (i = 1; i < n && part[i] != "static"; i++) ;
+    target = part[i + 1]
+    for (j = i + 2; j <= n; j++) target = target "/" part[j]
+    print target
+}' | sort | uniq -d | sed 's/^/glue-static shadowed /'
+if [ ! -e "$state" ] || [ "$(head -n 1 "$state")" != "$(head -n 1 "$state.new")" ]; then
+    echo "glue-static full"
+    exit 0
+fi
+sort "$state" > "$state.old.sorted"
+sort "$state.new" > "$state.new.sorted"
+comm -13 "$state.old.sorted" "$state.new.sorted" | cut -d ' ' -f 2- | sed 's/^/glue-static changed /'
+rm -f "$state.old.sorted" "$state.new.sorted"
+"""
+
+
+def _static_root():
+    """
+    The STATIC_ROOT collectstatic fills: public_path is taken from
+    GLUE_SETTINGS, as env's absolute one points at current with releases
+    """
+    return os.path.join(env.path, _setting('public_path', 'public'), _conf('static_path', 'static'))
+
+
+def _static_target(source):
+    """
+    Where collectstatic puts a static source: the path below its static/
+    directory, like the app directories and STATICFILES_DIRS finders do
+    """
+    parts = source.split('/')
+    return '/'.join(parts[parts.index('static') + 1:])
 
 
-def collectstatic():
+@_requires('installreqs', 'upload_secrets', 'upload_virtualenv_vendors', 'gitpull')
+@_inputs(_deployed_revision)
+def collectstatic(full=''):
     """
-    Collect static for django application.
+    Collect static for django application. Only the static sources that
+    changed since the last run are copied, and nothing is done when none
+    did. full=yes runs manage.py collectstatic anyway, as does a storage
+    other than FileSystemStorage or a change to a file another overrides
     """
     require('hosts')
     if env.flavor in ('prod', 'staging',):
-        with cd(env.path):
-            print '-- collectstatic // collecting static files for app'
-            sudo('FLAVOR=%s %s/bin/python manage.py collectstatic --noinput' % (
-                env.flavor, env.venv_path), user=env.project_user)
+        started = time.time()
+        root = _static_root()
+        state = _state_path('static-manifest')
+        _own_state_dir()
+        with _settings(hide('stdout')):
+            result = _sudo(_shell_script(_STATIC_MANIFEST_SCRIPT % {
+                'path': env.path, 'state': state, 'venv_path': env.venv_path, 'root': root,
+            }), user=env.project_user)
+        lines = [l.split(' ', 2)[1:] for l in result.splitlines() if l.startswith('glue-static ')]
+        total = int(dict(l for l in lines if l[0] == 'total').get('total', 0))
+        changed = [l[1] for l in lines if l[0] == 'changed']
+        shadowed = set(l[1] for l in lines if l[0] == 'shadowed')
+        # hashed and manifest storages, and the finders' precedence between
+        # sources of the same file, are only honoured by collectstatic
+        if (full or ['full'] in lines or ['storage'] in lines or not _conf('incremental_static', True)
+                or any(_static_target(source) in shadowed for source in changed)):
+            with cd(env.path):
+                print '-- collectstatic // collecting static files for app'
+                _sudo('FLAVOR=%s %s/bin/python manage.py collectstatic --noinput' % (
+                    env.flavor, env.venv_path), user=env.project_user)
+            summary = 'collected all %d static files' % total
+        elif changed:
+            copies = ['mkdir -p "$(dirname "%s/%s")" && cp -p "%s" "%s/%s"' % (
+                root, _static_target(source), source, root, _static_target(source))
+                for source in changed]
+            with cd(env.path):
+                _sudo(_shell_script('set -e\n' + '\n'.join(copies)), user=env.project_user)
+            summary = 'copied %d of %d static files' % (len(changed), total)
+        else:
+            summary = 'static files unchanged, skipped all %d' % total
+        _sudo('mv -f %s.new %s' % (state, state), user=env.project_user)
+        print(green('-- collectstatic // %s in %.1fs' % (summary, time.time() - started)))
 
 
-def update():
+def update(force=''):
     """
-    Updates app with newest source code, clears caches, and restarts gunicorn
+    Updates app with newest source code, clears caches, and restarts gunicorn.
+    If a previous update of the same revision failed, the steps that did
+    finish are skipped. force=all (or a list of steps) runs them anyway
     """
     require('hosts')
+    if _conf('releases'):
+        steps = ['release', 'gracefulreload', '_bumpcaches', 'warmup']
+    else:
+        steps = ['gitpull', 'collectstatic', 'gracefulreload', '_bumpcaches', 'warmup']
+    if _conf('migrate_on_update'):
+        steps.append('migrate')
+    if _conf('search_index'):
+        steps.append('searchreindex')
     with cd(env.path):
-        gitpull()
-        collectstatic()
-        restart()
+        _pipeline(steps, checkpoints='update', force=force, keep=False)
 
-        if env.redis_enabled:
-            print(cyan('-- redis // increasing cache generation key'))
-            redis_increase_gen()
 
-        if env.memcached_enabled:
+@_requires('restart', 'gracefulreload')
+@_inputs(_deployed_revision)
+def _bumpcaches():
+    """
+    Invalidates the redis/memcached caches, if enabled
+    """
+    if env.redis_enabled:
+        print(cyan('-- redis // increasing cache generation key'))
+        redis_increase_gen()
+
+    if env.memcached_enabled:
+        if _conf('memcached_gen_key'):
+            print(cyan('-- memcached // increasing cache generation key'))
+            memcached_increase_gen()
+        else:
             flushmemcached()
 
 
+# (prepare, activate) steps for tasks that rollout() can spread over hosts.
+# prepare runs on every host while it keeps serving, activate takes it down
+_ROLLOUT_PHASES = {
+    'update': (('gitpull', 'collectstatic'), ('gracefulreload', '_bumpcaches', 'warmup')),
+    'restart': ((), ('restart',)),
+    'gracefulreload': ((), ('gracefulreload',)),
+}
+
+# update's phases when releases are on: the release is prepared while the
+# host serves, and only the symlink switch and reload take it down
+_RELEASE_PHASES = (('_prepare_release',), ('_switch_release', 'gracefulreload', '_bumpcaches', 'warmup'))
+
+
+def _update_shared():
+    """
+    update's steps on what all hosts share, the database and the search
+    index, which rollout runs on the first prepared host before any is
+    activated: in the prepared release when releases are on
+    """
+    path = env.path
+    if _conf('releases'):
+        with _settings(hide('running', 'stdout')):
+            sha = _sudo('cat "%s/releases/.prepared"' % _release_base()).strip()
+        path = os.path.join(_release_base(), 'releases', sha)
+    with _settings(path=path):
+        if _conf('migrate_on_update'):
+            migrate()
+        if _conf('search_index'):
+            searchreindex(primary=env.host_string)
+
+
+def _project_path(flavor, settings):
+    """
+    Builds env.path for flavor: the checkout, or the current symlink into
+    releases/ when releases are on
+    """
+    path = os.path.join(settings[flavor]['project_base'], settings['project_name'])
+    if settings[flavor].get('releases'):
+        path = os.path.join(path, 'current')
+    return path
+
+
+def _hosts_for(flavor, settings):
+    """
+    Builds the env.hosts list for flavor. A flavor can list its own
+    'hosts' (as host or host:port), otherwise ssh_host is used, which can
+    also be a list
+    """
+    hosts = settings[flavor].get('hosts') or settings['ssh_host']
+    if isinstance(hosts, basestring):
+        hosts = [hosts]
+    host_strings = []
+    for host in hosts:
+        if ':' not in host:
+            host = '%s:%s' % (host, settings['ssh_port'])
+        host_strings.append('%s@%s' % (settings['ssh_user'], host))
+    return host_strings
+
+
+def _timed_call(names, capture=False):
+    """
+    Runs the named glue tasks on the current host. Returns the seconds
+    taken, the error if one was raised and, with capture, the output
+    """
+    if env.parallel:
+        # fabric gives each parallel host its own connection
+        _SESSIONS.clear()
+    buf = _StringIO()
+    saved = sys.stdout, sys.stderr
+    if capture:
+        sys.stdout = sys.stderr = buf
+    start = time.time()
+    trace_start = len(_TRACE)
+    failure = None
+    try:
+        for name in names:
+            globals()[name]()
+    except SystemExit:
+        failure = 'aborted'
+    except Exception as e:
+        failure = '%s: %s' % (e.__class__.__name__, e)
+    finally:
+        sys.stdout, sys.stderr = saved
+    return {
+        'seconds': time.time() - start,
+        'error': failure,
+        'output': buf.getvalue(),
+        'pid': os.getpid(),
+        'trace': _TRACE[trace_start:],
+    }
+
+
+def _phase(names, hosts, pool_size):
+    """
+    Runs names on hosts, in parallel if there is more than one host.
+    Output is held back per host so it doesn't interleave
+    """
+    if not names or not hosts:
+        return {}
+    parallel = len(hosts) > 1 and pool_size > 1
+    with _settings(hide('running', 'status'), parallel=parallel, pool_size=pool_size):
+        results = execute(_timed_call, names, capture=parallel, hosts=hosts)
+    for result in results.values():
+        if isinstance(result, dict):
+            _merge_trace(result)
+    return results
+
+
+@runs_once
+def rollout(task='update', pool_size='', batch_size=''):
+    """
+    Runs update or restart on all hosts. Code is prepared on every host
+    in parallel (pool_size at a time), then hosts are restarted batch_size
+    at a time. batch_size=1 keeps all other hosts serving; 0 restarts all
+    """
+    require('hosts')
+    if task not in _ROLLOUT_PHASES:
+        abort('rollout: task must be one of %s' % ', '.join(sorted(_ROLLOUT_PHASES)))
+    pool_size = int(pool_size or _conf('deploy_pool_size', 5))
+    batch_size = int(batch_size or _conf('deploy_batch_size', 1)) or len(env.hosts)
+    prepare, activate = _ROLLOUT_PHASES[task]
+    if task == 'update' and _conf('releases'):
+        prepare, activate = _RELEASE_PHASES
+
+    print(cyan('-- rollout // %s on %d host(s), pool of %d, restarting %d at a time' % (
+        task, len(env.hosts), pool_size, batch_size)))
+    prepared = _phase(prepare, env.hosts, pool_size)
+    ready = [h for h in env.hosts if not prepared.get(h, {}).get('error')]
+    if task == 'update' and ready and (_conf('migrate_on_update') or _conf('search_index')):
+        # no host runs the new code before the database is migrated
+        print(cyan('-- rollout // migrating and indexing from %s' % ready[0]))
+        shared = _phase(['_update_shared'], ready[:1], pool_size)[ready[0]]
+        prepared[ready[0]]['seconds'] += shared['seconds']
+        prepared[ready[0]]['output'] += shared['output']
+        if shared['error']:
+            prepared[ready[0]]['error'] = shared['error']
+            ready = []
+
+    activated = {}
+    for i in range(0, len(ready), batch_size):
+        hosts = ready[i:i + batch_size]
+        print(cyan('-- rollout // activating %s' % ', '.join(hosts)))
+        activated.update(_phase(activate, hosts, pool_size))
+        if any(activated[h]['error'] for h in hosts):
+            print(red('-- rollout // stopping, hosts in this batch failed'))
+            break
+
+    _rollout_summary(env.hosts, prepared, activated)
+
+
+def _rollout_summary(hosts, prepared, activated):
+    """
+    Prints per host timings, and the output of failed hosts
+    """
+    print(cyan('-- rollout // %-40s %9s %9s  %s' % ('host', 'prepare', 'activate', 'status')))
+    failed = False
+    for host in hosts:
+        cells = []
+        status = 'ok'
+        for results in (prepared, activated):
+            result = results.get(host)
+            cells.append(result and '%8.1fs' % result['seconds'] or '%9s' % '-')
+            if result and result['error']:
+                status = 'FAILED (%s)' % result['error']
+        if host not in activated and status == 'ok':
+            status = 'skipped'
+        failed = failed or status != 'ok'
+        line = '-- rollout // %-40s %s %s  %s' % (host, cells[0], cells[1], status)
+        print(status == 'ok' and green(line) or red(line))
+
+    for host in hosts:
+        for results in (prepared, activated):
+            result = results.get(host)
+            if result and result['error'] and result['output']:
+                print(red('-- rollout // output from %s:' % host))
+                print(result['output'])
+    if failed:
+        abort('rollout: not all hosts were updated')
+
+
+def _flavor_env(flavor, settings):
+    """
+    The env a generated fabfile's prod() or staging() sets up, for a
+    project's settings
+    """
+    flavor_settings = settings[flavor]
+    values = {
+        'flavor': flavor,
+        'procname': flavor_settings['process_name'],
+        'user': settings['ssh_user'],
+        'host': settings['ssh_host'],
+        'port': settings['ssh_port'],
+        'hosts': _hosts_for(flavor, settings),
+        'venv_root': flavor_settings['venv_root'],
+        'venv_name': flavor_settings['venv_name'],
+        'venv_path': os.path.join(flavor_settings['venv_root'], flavor_settings['venv_name']),
+        'path': _project_path(flavor, settings),
+        'repo': flavor_settings['repo'],
+        'branch': flavor_settings['git_branch'],
+        'project_user': settings['project_name'],
+        'project_group': settings['project_group'],
+        'memcached_enabled': flavor_settings['memcached_enabled'],
+        'redis_enabled': flavor_settings['redis_enabled'],
+        'redis_key': flavor_settings['redis_key'],
+        'db_user': flavor_settings['db_user'],
+        'db_name': flavor_settings['db_name'],
+        'db_pass': flavor_settings['db_pass'],
+        'project_name': settings['project_name'],
+    }
+    values['public_path'] = os.path.join(values['path'], flavor_settings['public_path'])
+    values['media_path'] = os.path.join(values['public_path'], flavor_settings['media_path'])
+    return values
+
+
+# run by another python with the project's DJANGO_SETTINGS_MODULE, since
+# django's settings can only be set up once per process
+_SETTINGS_DUMP = ('import cPickle, sys; from glue.settings import GLUE_SETTINGS; '
+                  'sys.stdout.write(cPickle.dumps(dict(GLUE_SETTINGS), 2))')
+
+
+def _project_settings(entries):
+    """
+    Loads the GLUE_SETTINGS of the projects in entries ('path' for a
+    project whose settings are <dirname>.settings, or 'path:module'), all
+    at once. Returns a list of (path, settings)
+    """
+    import glue
+    pythonpath = os.path.dirname(os.path.dirname(os.path.abspath(glue.__file__)))
+    loading = []
+    for entry in entries:
+        path, _, module = entry.partition(':')
+        path = os.path.abspath(os.path.expanduser(path))
+        module = module or '%s.settings' % os.path.basename(path.rstrip('/'))
+        child_env = dict(os.environ, DJANGO_SETTINGS_MODULE=module, PYTHONPATH=os.pathsep.join(
+            p for p in (pythonpath, os.environ.get('PYTHONPATH')) if p))
+        process = subprocess.Popen([sys.executable, '-c', _SETTINGS_DUMP], cwd=path, env=child_env,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        loading.append((path, module, process))
+    projects = []
+    for path, module, process in loading:
+        out, err = process.communicate()
+        if process.returncode:
+            abort('multi: could not load %s from %s:\n%s' % (module, path, err))
+        projects.append((path, cPickle.loads(out)))
+    return projects
+
+
+def _project_worker(host, pending, results, task):
+    """
+    Runs task for the projects it takes off pending, one after another,
+    so they share this process's connection to host (and each project
+    user's warm shell) instead of setting up their own
+    """
+    while True:
+        project = pending.get()
+        if project is None:
+            return
+        os.chdir(project['path'])
+        _REVISIONS.clear()
+        round_trips = _STATS['round_trips']
+        with _settings(host_string=host, glue_settings=project['settings'], **project['env']):
+            result = _timed_call([task], capture=True)
+        result['round_trips'] = _STATS['round_trips'] - round_trips
+        results.put((project['path'], host, result))
+
+
+@runs_once
+def multi(task='update', flavor='prod', projects='', jobs=''):
+    """
+    Runs task for many projects: fab multi:update,projects=~/a;~/b. Each
+    host gets up to jobs workers, each reusing one connection
+    """
+    if task.startswith('_') or task == 'multi' or not callable(globals().get(task)):
+        abort('multi: no such task %s' % task)
+    entries = projects and projects.split(';') or _conf('projects', [])
+    if not entries:
+        abort('multi: list projects in GLUE_SETTINGS or pass projects=path;path')
+    jobs = max(1, int(jobs or _conf('project_jobs', 4)))
+
+    by_host = {}
+    for path, settings in _project_settings(entries):
+        if flavor not in settings:
+            abort('multi: %s has no %s flavor' % (path, flavor))
+        values = _flavor_env(flavor, settings)
+        for host in values['hosts']:
+            by_host.setdefault(host, []).append({
+                'name': settings['project_name'], 'path': path,
+                'settings': settings, 'env': values})
+    print(cyan('-- multi // %s for %d project(s) on %d host(s), %d at a time per host' % (
+        task, len(entries), len(by_host), jobs)))
+
+    results = multiprocessing.Queue()
+    workers = []
+    for host, host_projects in sorted(by_host.items()):
+        pending = multiprocessing.Queue()
+        count = min(jobs, len(host_projects))
+        for project in host_projects + [None] * count:
+            pending.put(project)
+        for _ in range(count):
+            workers.append(multiprocessing.Process(
+                target=_project_worker, args=(host, pending, results, task)))
+    # the workers open their own connections
+    connections.clear()
+    _SESSIONS.clear()
+    _CACHE_CLIENTS.clear()
+    started = time.time()
+    for worker in workers:
+        worker.start()
+
+    names = dict((p['path'], p['name']) for ps in by_host.values() for p in ps)
+    expected = sum(len(p) for p in by_host.values())
+    finished = {}
+    while len(finished) < expected:
+        try:
+            path, host, result = results.get(timeout=1)
+        except _Empty:
+            if not any(worker.is_alive() for worker in workers):
+                break
+            continue
+        finished[(path, host)] = result
+        _STATS['round_trips'] += result['round_trips']
+        _merge_trace(result)
+        print(cyan('-- multi // %s on %s finished in %.1fs' % (names[path], host, result['seconds'])))
+    for worker in workers:
+        worker.join()
+    _multi_summary(by_host, finished, time.time() - started)
+
+
+def _multi_summary(by_host, finished, elapsed):
+    """
+    Prints per project and host timings, and the output of failed ones
+    """
+    print(cyan('-- multi // %-24s %-32s %8s %6s  %s' % ('project', 'host', 'time', 'trips', 'status')))
+    failed = []
+    for host, host_projects in sorted(by_host.items()):
+        for project in host_projects:
+            result = finished.get((project['path'], host))
+            if not result:
+                result = {'seconds': 0, 'round_trips': 0, 'output': '',
+                          'error': 'worker exited'}
+            status = result['error'] and 'FAILED (%s)' % result['error'] or 'ok'
+            line = '-- multi // %-24s %-32s %7.1fs %6d  %s' % (
+                project['name'], host, result['seconds'], result['round_trips'], status)
+            print(result['error'] and red(line) or green(line))
+            if result['error']:
+                failed.append((project['name'], host, result))
+    print(cyan('-- multi // %.1fs in total' % elapsed))
+    for name, host, result in failed:
+        if result['output']:
+            print(red('-- multi // output from %s on %s:' % (name, host)))
+            print(result['output'])
+    if failed:
+        abort('multi: %d of %d project run(s) failed' % (
+            len(failed), sum(len(p) for p in by_host.values())))
+
+
+@_requires('createuser')
+@_inputs('%(venv_name)s', 'conf/.bash_profile_source')
+@_probes('%(venv_path)s')
 def mkvirtualenv():
     """
     Setup a fresh virtualenv.
     """
     require('hosts')
     print(cyan('-- mkvirtualenv // uploading bash_profile...'))
-    put('conf/.bash_profile_source', '/home/%s/.bash_profile' % env.project_user, use_sudo=True)
-    print(cyan('-- mkvirtualenv // setting owner and permissions 660'))
-    _setowner(os.path.join('/home', env.project_user, '.bash_profile'))
-    _setperms('660', os.path.join('/home', env.project_user, '.bash_profile'))
-    print(cyan('-- mkvirtualenv // running virtualenvwrapper.sh'))
-    sudo('export WORKON_HOME=/sites/.virtualenvs', user=env.project_user)
-    with shell_env(WORKON_HOME='/sites/.virtualenvs'):
-        sudo('source /usr/local/bin/virtualenvwrapper.sh', user=env.project_user)
-    print(cyan('-- mkvirtualenv // chmoding hook.log to avoid permission trouble'))
-    with _settings(warn_only=True):
-        _setperms('660', os.path.join(env.venv_root, 'hook.log'))
-        _setowner(os.path.join(env.venv_root, 'hook.log'))
+    _put('conf/.bash_profile_source', '/home/%s/.bash_profile' % env.project_user, use_sudo=True)
+    with _batch():
+        print(cyan('-- mkvirtualenv // setting owner and permissions 660'))
+        _setowner(os.path.join('/home', env.project_user, '.bash_profile'))
+        _setperms('660', os.path.join('/home', env.project_user, '.bash_profile'))
+        print(cyan('-- mkvirtualenv // running virtualenvwrapper.sh'))
+        _sudo('export WORKON_HOME=/sites/.virtualenvs', user=env.project_user)
+        with shell_env(WORKON_HOME='/sites/.virtualenvs'):
+            _sudo('source /usr/local/bin/virtualenvwrapper.sh', user=env.project_user)
+        print(cyan('-- mkvirtualenv // chmoding hook.log to avoid permission trouble'))
+        with _settings(warn_only=True):
+            _setperms('660', os.path.join(env.venv_root, 'hook.log'))
+            _setowner(os.path.join(env.venv_root, 'hook.log'))
     with _settings(warn_only=True):
         if _exists(env.venv_path):
             print(yellow('-- mkvirtualenv // virtualenv %s already exists - now removing.' % env.venv_path))
-            sudo('export WORKON_HOME=/sites/.virtualenvs && source /usr/local/bin/virtualenvwrapper.sh && rmvirtualenv %s' % env.venv_name, user=env.project_user)
-    sudo('export WORKON_HOME=/sites/.virtualenvs && source /usr/local/bin/virtualenvwrapper.sh && mkvirtualenv %s' % env.venv_name, user=env.project_user)
+            _sudo('export WORKON_HOME=/sites/.virtualenvs && source /usr/local/bin/virtualenvwrapper.sh && rmvirtualenv %s' % env.venv_name, user=env.project_user)
+    _sudo('export WORKON_HOME=/sites/.virtualenvs && source /usr/local/bin/virtualenvwrapper.sh && mkvirtualenv %s' % env.venv_name, user=env.project_user)
+    _fact(env.venv_path, True)
+    _fact(os.path.join(env.venv_path, 'node_modules'), False)
 
 
+@_requires('deploy')
+@_inputs('%(project_name)s/conf/env/secrets.cfg')
 def upload_secrets():
     """
     Uploads secrets.cfg
     """
+    secrets = _shared_path('%s/conf/env/secrets.cfg' % env.project_name)
+    if secrets != os.path.join(env.path, env.project_name, 'conf/env/secrets.cfg'):
+        # put() would replace the release's symlink with a file
+        _sudo('mkdir -p "%s"' % os.path.dirname(secrets), user=env.project_user)
     print(cyan('-- upload_secrets // uploading secrets.cfg...'))
-    put('%s/conf/env/secrets.cfg' % env.project_name, '%s/%s/conf/env/secrets.cfg' % (env.path, env.project_name), use_sudo=True)
-    print(cyan('-- upload_secrets // chowning...'))
-    _setowner(os.path.join(env.path, env.project_name, 'conf/env/secrets.cfg'))
-    print(cyan('-- upload_secrets // chmoding'))
-    _setperms('660', os.path.join(env.path, env.project_name, 'conf/env/secrets.cfg'))
+    _put('%s/conf/env/secrets.cfg' % env.project_name, secrets, use_sudo=True)
+    with _batch():
+        print(cyan('-- upload_secrets // chowning...'))
+        _setowner(secrets)
+        print(cyan('-- upload_secrets // chmoding'))
+        _setperms('660', secrets)
 
 
+@_requires('mkvirtualenv')
+@_inputs('vendors/virtualenv/node_modules')
 def upload_virtualenv_vendors():
     """
-    Uploads virtualenv vendors
+    Uploads virtualenv vendors, owned by the project and 770, unless they
+    are unchanged since the last upload
     """
-    if not _exists(os.path.join(env.venv_path, 'node_modules')):
-        print(cyan('-- upload_virtualenv_vendors // uploading node_modules'))
-        put('vendors/virtualenv/node_modules', '%s/' % env.venv_path, use_sudo=True)
-        print(cyan('-- upload_virtualenv_vendors // chowning...'))
-        _setowner(os.path.join(env.venv_path, 'node_modules'))
-        print(cyan('-- upload_virtualenv_vendors // chmoding'))
-        _setperms('770', os.path.join(env.venv_path, 'node_modules'))
+    print(cyan('-- upload_virtualenv_vendors // uploading node_modules'))
+    _put_tree('vendors/virtualenv/node_modules',
+              os.path.join(env.venv_path, 'node_modules'), mode='770')
 
 
-def bootstrap():
+def bootstrap(force=''):
     """
-    Bootstraps and provisions project on host
+    Bootstraps and provisions project on host. Steps that finished before
+    are skipped while their inputs are unchanged, so a failed bootstrap
+    resumes where it stopped. force=all (or a list of steps) reruns them
     """
     require('hosts')
     _warn('''
@@ -140,23 +1845,26 @@ def bootstrap():
         files both in conf/ and in the fabfile.py itself!
     ''')
     _confirmtask()
-    createuser()
-    deploy()
-    mkvirtualenv()
-    upload_virtualenv_vendors()
-    upload_secrets()
-    installreqs()
-    createdb()
-    supervisorcfg()
-    nginxcfg()
-    logrotatecfg()
-    syncdb()
-    migrate()
-    collectstatic()
-    gitpull()
-    flushdb()
-    loaddata()
-    restart()
+    # steps run concurrently where their @_requires allow it
+    _pipeline([
+        'createuser',
+        'deploy',
+        'mkvirtualenv',
+        'upload_virtualenv_vendors',
+        'upload_secrets',
+        'installreqs',
+        'createdb',
+        'supervisorcfg',
+        'nginxcfg',
+        'logrotatecfg',
+        'syncdb',
+        'migrate',
+        'collectstatic',
+        'gitpull',
+        'flushdb',
+        'loaddata',
+        'restart',
+    ], checkpoints='bootstrap', force=force)
     _success()
 
 
@@ -169,6 +1877,8 @@ def _warn(str):
     print(red('-- WARNING ---------------------------------------'))
 
 
+@_requires('supervisorcfg', 'nginxcfg', 'collectstatic', 'migrate', 'loaddata', 'release')
+@_inputs(_deployed_revision)
 def restart():
     """
     Restarts the gunicorn process through supervisorctl
@@ -176,7 +1886,168 @@ def restart():
     require('hosts')
     with cd(env.path):
         print(cyan('-- supervisor // restarting gunicorn process'))
-        sudo('supervisorctl restart %s' % env.procname)
+        _sudo('supervisorctl restart %s' % env.procname)
+
+
+# sends HUP to the gunicorn master supervisor runs and waits until all its
+# workers are new ones and answer the health check
+_RELOAD_SCRIPT = """
+%(own_state)strue
+old=$(supervisorctl pid %(procname)s)
+[ "$old" -gt 0 ] 2>/dev/null || { echo "glue-reload not running"; exit 3; }
+workers=" $(pgrep -P $old | tr '\\n' ' ')"
+start=$(date +%%s.%%N)
+deadline=$(( $(date +%%s) + %(timeout)s ))
+kill -HUP $old
+while [ $(date +%%s) -lt $deadline ]; do
+    sleep 0.2
+    current=" $(pgrep -P $old | tr '\\n' ' ')"
+    [ "$current" != " " ] || continue
+    stale=no
+    for pid in $current; do
+        case "$workers" in *" $pid "*) stale=yes ;; esac
+    done
+    [ $stale = no ] || continue
+    if [ -n "%(health_url)s" ]; then
+        curl -fsS -o /dev/null -m 2 "%(health_url)s" || continue
+    fi
+    end=$(date +%%s.%%N)
+    echo "$(date '+%%Y-%%m-%%d %%H:%%M:%%S') %(mode)s $start $end" >> "%(log)s"
+    echo "glue-reload ok $start $end"
+    exit 0
+done
+echo "glue-reload timeout"
+exit 4
+"""
+
+
+@_requires('supervisorcfg', 'nginxcfg', 'collectstatic', 'migrate', 'loaddata', 'release')
+@_inputs(_deployed_revision)
+def gracefulreload(mode=''):
+    """
+    Reloads gunicorn without dropping requests. mode=hup (default) makes
+    the master supervisor runs replace its workers gracefully, and waits
+    for health_url to answer; on reload_timeout it falls back to a hard
+    restart. mode=restart just restarts
+    """
+    require('hosts')
+    mode = (mode or _conf('reload_mode', 'hup')).lower()
+    if mode == 'restart':
+        return restart()
+    if mode != 'hup':
+        # a new master (USR2) would no longer be the process supervisor runs
+        abort('gracefulreload: mode must be hup or restart')
+    log = _state_path('reloads.log')
+    print(cyan('-- supervisor // reloading gunicorn process (%s)' % mode))
+    with _settings(hide('running', 'stdout'), warn_only=True):
+        result = _sudo(_shell_script(_RELOAD_SCRIPT % {
+            'own_state': _state_dir_command(),
+            'procname': env.procname,
+            'health_url': _conf('health_url', ''),
+            'timeout': int(_conf('reload_timeout', 60)),
+            'mode': mode,
+            'log': log,
+        }))
+    marker = [l.split() for l in result.splitlines() if l.startswith('glue-reload')]
+    if result.succeeded and marker and marker[-1][1] == 'ok':
+        seconds = float(marker[-1][3]) - float(marker[-1][2])
+        _STATS['reloads'].append((env.host_string, mode, seconds))
+        print(green('-- supervisor // new workers answering after %.1fs' % seconds))
+    else:
+        print(yellow('-- supervisor // graceful reload failed (%s), restarting' % (
+            marker and ' '.join(marker[-1][1:]) or result.return_code)))
+        restart()
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values and values[min(len(values) - 1, int(len(values) * fraction))] or 0.0
+
+
+def _warmup_urls():
+    """
+    warmup_urls, and the locations in warmup_sitemap, up to warmup_limit.
+    Paths are joined to warmup_base_url, which may use %(host)s
+    """
+    base = _conf('warmup_base_url', '') % {'host': env.host}
+    urls = list(_conf('warmup_urls', []))
+    if _conf('warmup_sitemap'):
+        sitemap = urllib2.urlopen(base + _conf('warmup_sitemap'), timeout=10).read()
+        urls.extend(re.findall(r'<loc>\s*([^<\s]+)\s*</loc>', sitemap))
+    urls = urls[:int(_conf('warmup_limit', 200))]
+    return [url if '://' in url else base + url for url in urls]
+
+
+def _warmup_round(urls, requests, concurrency):
+    """
+    Requests every url requests times, shuffled, from concurrency threads.
+    Returns url: [seconds, ...] with None for failures
+    """
+    jobs = _Queue()
+    schedule = urls * requests
+    random.shuffle(schedule)
+    for url in schedule:
+        jobs.put(url)
+    timings = dict((url, []) for url in urls)
+
+    def work():
+        while True:
+            try:
+                url = jobs.get_nowait()
+            except _Empty:
+                return
+            started = time.time()
+            try:
+                urllib2.urlopen(urllib2.Request(url, headers={'User-Agent': 'glue-warmup'}),
+                                timeout=int(_conf('warmup_timeout', 30))).read()
+                timings[url].append(time.time() - started)
+            except Exception:
+                timings[url].append(None)
+
+    threads = [threading.Thread(target=work) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return timings
+
+
+@_requires('_bumpcaches')
+def warmup(requests='', concurrency=''):
+    """
+    Primes caches and workers after a deploy: requests each warmup_urls
+    (and warmup_sitemap) url, requests times (default: once per gunicorn
+    worker) at most concurrency at a time, in rounds until the p95 is
+    below warmup_p95 seconds. Fails if it isn't after warmup_rounds rounds
+    """
+    require('hosts')
+    urls = _warmup_urls()
+    if not urls:
+        return
+    if not requests:
+        with _settings(hide('running', 'stdout'), warn_only=True):
+            workers = _sudo('ps --no-headers --ppid "$(supervisorctl pid %s)" | wc -l' % env.procname)
+        requests = workers.strip().isdigit() and max(1, int(workers)) or 1
+    requests, concurrency = int(requests), int(concurrency or _conf('warmup_concurrency', 8))
+    threshold = float(_conf('warmup_p95', 1.0))
+    for attempt in range(1, int(_conf('warmup_rounds', 5)) + 1):
+        print(cyan('-- warmup // round %d: %d urls x %d, %d at a time' % (
+            attempt, len(urls), requests, concurrency)))
+        timings = _warmup_round(urls, requests, concurrency)
+        answered = [t for times in timings.values() for t in times if t is not None]
+        failed = sum(times.count(None) for times in timings.values())
+        p95 = _percentile(answered, 0.95)
+        for url in sorted(timings, key=lambda u: -_percentile([t for t in timings[u] if t is not None], 0.5)):
+            times = [t for t in timings[url] if t is not None]
+            print('  %6.0fms median %6.0fms max %3d failed  %s' % (
+                _percentile(times, 0.5) * 1000, max(times or [0]) * 1000,
+                timings[url].count(None), url))
+        print(cyan('-- warmup // p95 %.0fms, %d failed' % (p95 * 1000, failed)))
+        if answered and p95 <= threshold and not failed:
+            print(green('-- warmup // warm'))
+            return
+    abort('warmup: p95 still %.0fms (over %.0fms) or requests failing after %d rounds' % (
+        p95 * 1000, threshold * 1000, attempt))
 
 
 def stop():
@@ -186,7 +2057,7 @@ def stop():
     require('hosts')
     with cd(env.path):
         print(cyan('-- supervisor // stopping gunicorn process'))
-        sudo('supervisorctl stop %s' % env.procname)
+        _sudo('supervisorctl stop %s' % env.procname)
 
 
 def start():
@@ -196,12 +2067,75 @@ def start():
     require('hosts')
     with cd(env.path):
         print(cyan('-- supervisor // starting gunicorn process'))
-        sudo('supervisorctl start %s' % env.procname)
+        _sudo('supervisorctl start %s' % env.procname)
+
+
+def _state_path(name):
+    """
+    Path of a glue bookkeeping file on the host, kept outside the checkout
+    """
+    return os.path.join(_conf('project_base'), '.glue', '%s-%s' % (env.procname, name))
+
+
+def _state_dir_command():
+    """
+    The command, to run as root, that creates the directory of
+    _state_path() owned by project_user, who writes most of the state kept
+    there. A project_base it has to create is owned by project_user too,
+    as deploy creates the checkout in it as that user. Empty once it ran
+    on this host
+    """
+    path = os.path.dirname(_state_path(''))
+    if (env.host_string, 'state:%s' % path) in _FACTS:
+        return ''
+    _fact('state:%s' % path, True)
+    owner = '%s:%s' % (env.project_user, env.project_group)
+    base = os.path.dirname(path)
+    return ('{ [ -d "%s" ] || { mkdir -p "%s" && chown "%s" "%s"; }; } && '
+            'mkdir -p "%s" && chown "%s" "%s" && ' % (base, base, owner, base, path, owner, path))
+
+
+def _own_state_dir():
+    """
+    Runs _state_dir_command(), before project_user writes state
+    """
+    command = _state_dir_command()
+    if command:
+        _sudo(command + 'true')
 
 
-def _setperms(perms, path):
+def _fix(command, path, since=None):
+    """
+    Applies command (e.g. 'chmod 660') to path and everything below it.
+    since=None walks the whole tree. since='marker' only touches what
+    changed since the last fix of path. Anything else is a git revision,
+    and only files changed between it and HEAD in the path checkout (and
+    their directories) are touched
     """
-    chmods path to perms, recursively
+    marker = _state_path('fix-%s' % re.sub(r'\W+', '_', '%s %s' % (command, path)).strip('_'))
+    walk = '%s -R "%s"' % (command, path)
+    if since is None:
+        fix = walk
+    elif since == 'marker':
+        fix = 'if [ -e "%s" ]; then find "%s" -cnewer "%s" -print0 | xargs -0 -r %s --; else %s; fi' % (
+            marker, path, marker, command, walk)
+    else:
+        fix = ("(cd \"%s\" && git -c 'safe.directory=*' -c core.quotepath=off "
+               "diff --name-only --diff-filter=d %s HEAD "
+               "| awk -F/ '{p = \"\"; for (i = 1; i < NF; i++) {p = p $i \"/\"; print p}; print}' "
+               "| sort -u | tr '\\n' '\\0' | xargs -0 -r %s --)" % (path, since, command))
+    if since is None or since == 'marker':
+        # once a whole tree is fixed, the marker is stamped, after fixing:
+        # chown and chmod change the ctime of what they touch, which would
+        # otherwise all count as changed. ctime rather than mtime, since
+        # rsync and tar keep the mtimes they got
+        fix = '%s%s && { [ ! -d "%s" ] || touch "%s"; }' % (_state_dir_command(), fix, path, marker)
+    _sudo(fix)
+
+
+def _setperms(perms, path, since=None):
+    """
+    chmods path to perms, recursively. See _fix() for since
     """
     if not perms:
         abort('_setperms: not enough arguments. perms=%s, path=%s' % (perms, path))
@@ -209,52 +2143,172 @@ def _setperms(perms, path):
         abort('_setperms: not enough arguments. perms=%s, path=%s' % (perms, path))
 
     require('hosts')
-    print(cyan('-- setperms // setting %s on %s [recursively]' % (perms, path)))
-    sudo('chmod -R %s "%s"' % (perms, path))
+    print(cyan('-- setperms // setting %s on %s [%s]' % (
+        perms, path, since and 'changed files' or 'recursively')))
+    _fix('chmod %s' % perms, path, since)
 
 
-def _setowner(path=''):
+def _setowner(path='', since=None):
     """
-    chowns provided path to project_user:project_group
+    chowns provided path to project_user:project_group. See _fix() for since
     """
     if not path:
         abort('_setowner: cannot be empty')
     require('hosts')
-    print(cyan('-- setowner // owning %s [recursively]' % path))
-    sudo('chown %s:%s -R "%s"' % (env.project_user, env.project_group, path))
+    print(cyan('-- setowner // owning %s [%s]' % (
+        path, since and 'changed files' or 'recursively')))
+    _fix('chown %s:%s' % (env.project_user, env.project_group), path, since)
+
+
+def _local_media_manifest(root):
+    """
+    path: [size, mtime] for every file below root on this machine
+    """
+    manifest = {}
+    for directory, _, files in os.walk(root):
+        for name in files:
+            path = os.path.join(directory, name)
+            stat = os.lstat(path)
+            manifest[os.path.relpath(path, root)] = [stat.st_size, int(stat.st_mtime)]
+    return manifest
+
+
+def _remote_media_manifest():
+    """
+    path: [size, mtime] for every file below the media path on the host,
+    in one call
+    """
+    with _settings(hide('stdout')):
+        listing = _sudo("mkdir -p %s && find %s -type f -printf '%%P\\t%%s\\t%%T@\\n'" % (
+            env.media_path, env.media_path))
+    manifest = {}
+    for line in listing.splitlines():
+        path, size, mtime = line.rstrip('\r').rsplit('\t', 2)
+        manifest[path] = [int(size), int(float(mtime))]
+    return manifest
+
+
+def _media_hashes(root, paths):
+    """
+    md5 of paths below root, locally and on the host, for files whose size
+    matches but mtime doesn't
+    """
+    hashes = {}
+    for path in paths:
+        with open(os.path.join(root, path), 'rb') as f:
+            hashes[path] = [hashlib.md5(f.read()).hexdigest()]
+    listing = _sudo(_shell_script('cd "%s" && md5sum %s' % (
+        env.media_path, ' '.join("'%s'" % p.replace("'", "'\\''") for p in paths))))
+    for line in listing.splitlines():
+        digest, path = line.rstrip('\r').split('  ', 1)
+        hashes.setdefault(path, [None]).append(digest)
+    return set(path for path, digests in hashes.items()
+               if len(digests) == 2 and digests[0] == digests[1])
+
+
+def _media_diff(local, remote, base, policy):
+    """
+    Compares the local and remote manifests against the manifest of the
+    last sync. Returns the paths to push, to pull, and the conflicts
+    (changed on both sides) with how policy resolved them
+    """
+    push, pull, conflicts = [], [], []
+    for path in sorted(set(local) | set(remote)):
+        mine, theirs = local.get(path), remote.get(path)
+        if mine == theirs:
+            continue
+        if theirs is None or (mine is not None and theirs == base.get(path)):
+            push.append(path)
+        elif mine is None or mine == base.get(path):
+            pull.append(path)
+        else:
+            winner = {'local': 'push', 'remote': 'pull', 'skip': 'skip'}.get(
+                policy, mine[1] >= theirs[1] and 'push' or 'pull')
+            conflicts.append((path, winner))
+            if winner == 'push':
+                push.append(path)
+            elif winner == 'pull':
+                pull.append(path)
+    return push, pull, conflicts
 
 
-def syncmedia():
+def _rsync_parallel(paths, source, target, streams):
     """
-    Synchronizes local and remote media directories. Potentially messy.
+    Copies paths from source to target with up to streams rsync processes
+    at once, sharing the ssh master connection
+    """
+    chunks = [paths[i::streams] for i in range(min(streams, len(paths)))]
+    processes = []
+    for chunk in chunks:
+        process = subprocess.Popen("rsync -a --files-from=- -e '%s' %s %s" % (
+            _ssh_command(), source, target), shell=True, stdin=subprocess.PIPE)
+        process.stdin.write('\n'.join(chunk) + '\n')
+        process.stdin.close()
+        processes.append(process)
+    failed = [code for code in [p.wait() for p in processes] if code]
+    if failed:
+        abort('syncmedia: %d of %d rsync streams failed' % (len(failed), len(processes)))
+
+
+def syncmedia(dry_run='', policy='', streams=''):
+    """
+    Synchronizes local and remote media directories. Only files that
+    differ are copied, both ways, over several rsync streams. Files
+    changed on both sides since the last sync are conflicts, settled by
+    policy: newer (default), local, remote or skip. dry_run=yes only
+    shows what would be copied
     """
     require('hosts')
-    _confirmtask()
-    with cd(env.path):
-        _setperms('a+r', env.media_path)
-        fixprojectperms()
-        _setperms('g+w', env.public_path)
-        rsync_command = r"""rsync -av -e 'ssh -p %s' %s@%s:%s %s""" % (
-            env.port,
-            env.user, env.host,
-            env.media_path.rstrip('/') + '/',
-            'public/media'
-        )
-        #print(red(rsync_command))
-        print(cyan('-- syncmedia // syncing from server to local'))
-        print local(rsync_command, capture=False)
-
-        rsync_command = r"""rsync -av /sites/%s/public/media/ -e 'ssh -p %s' %s@%s:%s""" % (
-            env.project_user,
-            env.port,
-            env.user, env.host,
-            env.media_path.rstrip('/') + '/'
-        )
-
-        print(cyan('-- syncmedia // syncing from local to server'))
-        print local(rsync_command, capture=False)
-
-        _setowner(env.public_path)
+    started = time.time()
+    policy = policy or _conf('media_conflicts', 'newer')
+    streams = int(streams or _conf('media_streams', 4))
+    root = os.path.join(_setting('public_path', 'public'), _setting('media_path', 'media'))
+    state = os.path.join('.glue', 'media-%s.json' % env.flavor)
+    base = {}
+    if os.path.exists(state):
+        with open(state) as f:
+            base = json.load(f)
+    local, remote = _local_media_manifest(root), _remote_media_manifest()
+    if _conf('media_hash', False):
+        same_size = [path for path in set(local) & set(remote)
+                     if local[path][0] == remote[path][0] and local[path] != remote[path]]
+        for path in (same_size and _media_hashes(root, same_size) or ()):
+            remote[path] = local[path]
+    push, pull, conflicts = _media_diff(local, remote, base, policy)
+    print(cyan('-- syncmedia // %d local, %d remote files: %d to push, %d to pull, %d conflicts' % (
+        len(local), len(remote), len(push), len(pull), len(conflicts))))
+    for path, winner in conflicts:
+        print(yellow('-- syncmedia // conflict %s: %s' % (path, winner)))
+    if dry_run:
+        for path in push:
+            print('  > %s' % path)
+        for path in pull:
+            print('  < %s' % path)
+        return
+    if not push and not pull:
+        print(green('-- syncmedia // nothing to copy'))
+    else:
+        _confirmtask()
+        remote_root = '%s@%s:%s/' % (env.user, env.host, env.media_path.rstrip('/'))
+        if pull:
+            _setperms('a+r', env.media_path, since=_incremental())
+            print(cyan('-- syncmedia // pulling %d files' % len(pull)))
+            _rsync_parallel(pull, remote_root, root + '/', streams)
+        if push:
+            _setperms('g+w', env.media_path, since=_incremental())
+            print(cyan('-- syncmedia // pushing %d files' % len(push)))
+            _rsync_parallel(push, root + '/', remote_root, streams)
+            _setowner(env.media_path, since=_incremental())
+    # both sides now hold what was copied; remember it as the common state
+    for path in push:
+        remote[path] = local[path]
+    for path in pull:
+        local[path] = remote[path]
+    if not os.path.isdir('.glue'):
+        os.makedirs('.glue')
+    with open(state, 'w') as f:
+        json.dump(dict((path, local[path]) for path in local if remote.get(path) == local[path]), f)
+    print(green('-- syncmedia // done in %.1fs' % (time.time() - started)))
 
 
 def nukemedia():
@@ -268,25 +2322,78 @@ def nukemedia():
     print(red('command: rm -rf %s' % env.media_path))
     print(red('-- WARNING ---------------------------------------'))
     _confirmtask()
-    print(cyan('-- nukemedia // ok, deleting files.'))
-    sudo('rm -rf %s' % env.media_path)
-    print(cyan('-- nukemedia // recreating media directory'))
-    sudo('mkdir -p %s' % env.media_path, user=env.project_user)
-    _setowner(env.media_path)
-    _setperms('g+w', env.media_path)
+    with _batch():
+        print(cyan('-- nukemedia // ok, deleting files.'))
+        _sudo('rm -rf %s' % env.media_path)
+        print(cyan('-- nukemedia // recreating media directory'))
+        _sudo('mkdir -p %s' % env.media_path, user=env.project_user)
+        _setowner(env.media_path)
+        _setperms('g+w', env.media_path)
+
+
+def _stream_up(command, remote_path):
+    """
+    Pipes the output of the local command into remote_path on the host,
+    written as project_user over one ssh channel, with progress and
+    throughput. Nothing is buffered on either disk on the way
+    """
+    _forget(remote_path)
+    _flush()
+    _round_trip()
+    with _span('stream', remote_path) as event:
+        dump = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, executable='/bin/bash')
+        channel = connections[env.host_string].get_transport().open_session()
+        channel.set_combine_stderr(True)
+        channel.exec_command('sudo -n -H -u "%s" /bin/sh -c \'mkdir -p "%s" && cat > "%s"\'' % (
+            env.project_user, os.path.dirname(remote_path), remote_path))
+        sent, started, shown = 0, time.time(), time.time()
+        while True:
+            chunk = dump.stdout.read(1 << 20)
+            if not chunk:
+                break
+            channel.sendall(chunk)
+            sent += len(chunk)
+            event['bytes'] = sent
+            if time.time() - shown > 2:
+                shown = time.time()
+                print(cyan('-- putdata // %.1f MB sent, %.1f MB/s' % (
+                    sent / 1048576.0, sent / 1048576.0 / (shown - started))))
+        channel.shutdown_write()
+        status = channel.recv_exit_status()
+        dump.wait()
+        if dump.returncode or status:
+            abort('putdata: %s exited with %s, the host with %s: %s' % (
+                command, dump.returncode, status, channel.recv(4096).strip()))
+    elapsed = max(time.time() - started, 0.001)
+    print(green('-- putdata // %.1f MB into %s in %.1fs, %.1f MB/s' % (
+        sent / 1048576.0, remote_path, elapsed, sent / 1048576.0 / elapsed)))
+
+
+def _data_path():
+    """
+    Where putdata leaves the dump on the host, by data_format
+    """
+    if _conf('data_format', 'json') == 'pg':
+        return os.path.join(env.path, 'fixtures', 'application_db.dump')
+    return os.path.join(env.path, 'fixtures', 'application_db.json.gz')
 
 
 def putdata():
     """
-    Grabs a json dump of local dev database and uploads it to server
+    Streams a dump of local dev database to server: a gzipped dumpdata
+    json, or a pg_dump in custom format with data_format set to pg
     """
     require('hosts')
-    print local('FLAVOR=dev ./manage.py dumpdata > fixtures/application_db.json', capture=False)
-    _setperms('g+w', '%s/fixtures' % env.path)
-    put('fixtures/application_db.json', '%s/fixtures/application_db.json' % env.path, use_sudo=True)
-    _setowner(env.media_path)
+    if _conf('data_format', 'json') == 'pg':
+        command = 'pg_dump -Fc --no-owner --no-acl %s' % _conf('local_db_name', env.project_name)
+    else:
+        command = 'set -o pipefail; FLAVOR=dev ./manage.py dumpdata | gzip -1'
+    print(cyan('-- putdata // streaming %s' % command))
+    _stream_up(command, _data_path())
 
 
+@_requires('migrate', foreground=True)
+@_inputs('%(db_name)s')
 def flushdb():
     """
     Flush all data from database. Does not drop tables, only data.
@@ -300,12 +2407,15 @@ def flushdb():
     _confirmtask()
     with cd(env.path):
         print(cyan('-- flushdb // flushing database'))
-        sudo('FLAVOR=%s %s/bin/python manage.py sqlflush | psql %s' % (env.flavor, env.venv_path, env.db_name), user=env.project_user)
+        _sudo('FLAVOR=%s %s/bin/python manage.py sqlflush | psql %s' % (env.flavor, env.venv_path, env.db_name), user=env.project_user)
 
 
+@_requires('flushdb', foreground=True)
+@_inputs('fixtures/application_db.json')
 def loaddata():
     """
-    Loads fixtures/application_db.json into database
+    Loads what putdata streamed into database, or else
+    fixtures/application_db.json
     """
     require('hosts')
     print(red('-- WARNING ---------------------------------------------------------'))
@@ -314,9 +2424,28 @@ def loaddata():
     print(red('-- WARNING ---------------------------------------------------------'))
     print("")
     _confirmtask()
+    started = time.time()
     with cd(env.path):
-        print(cyan('-- loaddata // loading fixtures'))
-        sudo('FLAVOR=%s %s/bin/python manage.py loaddata fixtures/application_db.json' % (env.flavor, env.venv_path), user=env.project_user)
+        if _conf('data_format', 'json') == 'pg':
+            print(cyan('-- loaddata // restoring %s with %s jobs' % (
+                _data_path(), _conf('restore_jobs', 4))))
+            _sudo('pg_restore --clean --if-exists --no-owner --no-acl -j %s -d %s %s' % (
+                _conf('restore_jobs', 4), env.db_name, _data_path()), user=env.project_user)
+        else:
+            print(cyan('-- loaddata // loading fixtures'))
+            if _conf('fixture_batch_size'):
+                # streamed and bulk inserted model by model, see glue_loaddata
+                command = 'glue_loaddata --batch-size=%s --workers=%s' % (
+                    _conf('fixture_batch_size'), _conf('fixture_workers', 1))
+            else:
+                command = 'loaddata'
+            # what putdata streamed, or the fixture in the checkout. the
+            # stream is removed once loaded, so it never shadows a newer fixture
+            _sudo('f=%s; [ -e $f ] || f=fixtures/application_db.json; '
+                  'FLAVOR=%s %s/bin/python manage.py %s $f && rm -f %s' % (
+                      _data_path(), env.flavor, env.venv_path, command, _data_path()),
+                  user=env.project_user)
+    print(green('-- loaddata // loaded in %.1fs' % (time.time() - started)))
 
 
 def importfixtures():
@@ -328,7 +2457,7 @@ def importfixtures():
     with cd(env.path):
         flushdb()
         loaddata()
-        #sudo('FLAVOR=%s %s/bin/python manage.py migrate --noinput' % (env.flavor, env.venv_path), user=env.project_user)
+        #_sudo('FLAVOR=%s %s/bin/python manage.py migrate --noinput' % (env.flavor, env.venv_path), user=env.project_user)
 
 WORDLIST_PATHS = [os.path.join('/', 'usr', 'share', 'dict', 'words')]
 DEFAULT_MESSAGE = "Are you sure you want to do this?"
@@ -354,28 +2483,200 @@ def _confirmtask(msg=DEFAULT_MESSAGE, horror_rating=1):
         answer = prompt(p_msg, validate=r'^%s$' % word)
 
 
+@_requires('deploy')
+@_inputs(_deployed_revision)
 def gitpull():
     """
     Pulls latest commit from git, and resets permissions/owners
     """
     require('hosts')
+    if _conf('releases'):
+        # never change a release in place
+        return release(collect='')
     with cd(env.path):
         print(cyan('-- git // git pull, to make sure we are still at HEAD'))
-        sudo('git pull', user=env.project_user)
+        result = _sudo('git rev-parse HEAD && git pull', user=env.project_user)
+
+    fixprojectperms(since=result.splitlines()[0].strip())
+
+
+def fixprojectperms(since='', full=''):
+    """
+    Chowns the project directory to project_user:project_group. Only what
+    changed since the git revision since (or since the last fix) is
+    chowned, unless full is set or incremental_perms is off
+    """
+    require('hosts')
+    with _batch():
+        _setowner(env.path, since=_incremental(since, full))
+        logrotatecfg()
+
+
+_PREPARE_RELEASE_SCRIPT = """
+set -e
+base="%(base)s"
+mkdir -p "$base/releases" "$base/shared"
+if [ -d "$base/repo" ]; then
+    git --git-dir="$base/repo" fetch -q --prune origin
+else
+    git clone -q --mirror "%(origin)s" "$base/repo"
+fi
+sha=$(git --git-dir="$base/repo" rev-parse "%(branch)s")
+release="$base/releases/$sha"
+if [ ! -d "$release" ]; then
+    rm -rf "$release.tmp"
+    git clone -q --no-checkout "$base/repo" "$release.tmp"
+    git --git-dir="$release.tmp/.git" --work-tree="$release.tmp" checkout -q "$sha"
+    for shared in %(shared_dirs)s; do
+        mkdir -p "$base/shared/$shared"
+    done
+    for shared in %(shared_dirs)s %(shared_files)s; do
+        if [ -e "$release.tmp/$shared" ] && [ ! -e "$base/shared/$shared" ]; then
+            mkdir -p "$(dirname "$base/shared/$shared")"
+            mv "$release.tmp/$shared" "$base/shared/$shared"
+        fi
+        rm -rf "$release.tmp/$shared"
+        mkdir -p "$(dirname "$release.tmp/$shared")"
+        ln -s "$base/shared/$shared" "$release.tmp/$shared"
+    done
+    mv "$release.tmp" "$release"
+    echo "glue-release new $sha"
+else
+    echo "glue-release existing $sha"
+fi
+echo "$sha" > "$base/releases/.prepared"
+"""
+
+# points current at the release in $sha, atomically, and prunes old releases
+_SWITCH_RELEASE_SCRIPT = """
+set -e
+base="%(base)s"
+cd "$base/releases"
+%(select)s
+[ -n "$sha" ] && [ -d "$sha" ] || { echo "glue-release missing $sha"; exit 3; }
+ln -sfn "$base/releases/$sha" "$base/current.tmp"
+mv -Tf "$base/current.tmp" "$base/current"
+ls -1dt */ | sed 's#/$##' | tail -n +%(prune_from)s | grep -vx "$sha" | xargs -r rm -rf
+echo "glue-release current $sha"
+"""
+
+
+def _release_base():
+    """
+    The directory holding releases/, shared/ and the current symlink
+    """
+    return os.path.dirname(env.path)
 
-    fixprojectperms()
 
+def _shared_path(path):
+    """
+    Where path (relative to the project) really lives: in shared/ when
+    releases are on and it is one of the shared_paths, else in env.path
+    """
+    if _conf('releases'):
+        for shared in _conf('shared_paths', []):
+            if path == shared or (shared.endswith('/') and path.startswith(shared)):
+                return os.path.join(_release_base(), 'shared', path)
+    return os.path.join(env.path, path)
+
+
+def _release_sha(result):
+    """
+    Picks the sha out of the output of the release scripts
+    """
+    lines = [l.split()[2:] for l in result.splitlines() if l.startswith('glue-release')]
+    return lines and ''.join(lines[-1]) or ''
 
-def fixprojectperms():
+
+def _prepare_release(collect='yes'):
     """
-    Chowns the project directory to project_user:project_group
+    Fetches the branch into <base>/repo and checks the newest commit out
+    in releases/<sha>, with the shared_paths linked into shared/. Runs
+    collectstatic in it unless collect is empty
     """
     require('hosts')
-    _setowner(env.path)
-    logrotatecfg()
+    shared = _conf('shared_paths', [])
+    print(cyan('-- release // preparing the newest %s in %s/releases' % (
+        env.branch or 'HEAD', _release_base())))
+    with _settings(hide('stdout')):
+        result = _sudo(_shell_script(_PREPARE_RELEASE_SCRIPT % {
+            'base': _release_base(),
+            'origin': 'file:///code/git/%s' % env.repo,
+            'branch': env.branch or 'HEAD',
+            'shared_dirs': ' '.join('"%s"' % p.rstrip('/') for p in shared if p.endswith('/')),
+            'shared_files': ' '.join('"%s"' % p for p in shared if not p.endswith('/')),
+        }), user=env.project_user)
+    sha = _release_sha(result)
+    path = os.path.join(_release_base(), 'releases', sha)
+    if 'glue-release new' in result:
+        _setowner(path)
+        if collect:
+            with _settings(path=path):
+                collectstatic()
+    else:
+        print(yellow('-- release // %s was prepared before' % sha))
+    return sha
+
+
+def _switch_release(to=''):
+    """
+    Points current at the prepared release, or at the release to (a sha
+    or prefix), or at the one before the current one if to is 'previous'
+    """
+    require('hosts')
+    if to == 'previous':
+        select = ('current=$(basename "$(readlink "$base/current")")\n'
+                  'sha=$(ls -1dt */ | sed \'s#/$##\' | grep -A1 -x "$current" | sed -n 2p)')
+    elif to:
+        select = 'sha=$(ls -1d "%s"*/ | head -n 1 | sed \'s#/$##\')' % to
+    else:
+        select = 'sha=$(cat .prepared)'
+    with _settings(hide('stdout')):
+        result = _sudo(_shell_script(_SWITCH_RELEASE_SCRIPT % {
+            'base': _release_base(),
+            'select': select,
+            'prune_from': int(_conf('keep_releases', 5)) + 1,
+        }), user=env.project_user)
+    print(green('-- release // current is now %s' % _release_sha(result)))
+
+
+@_inputs(_deployed_revision)
+def release(collect='yes'):
+    """
+    Prepares the newest commit in its own releases/<sha> directory, then
+    switches the current symlink to it. Needs releases on in GLUE_SETTINGS
+    """
+    require('hosts')
+    if not _conf('releases'):
+        abort('release: turn on releases in GLUE_SETTINGS first')
+    _prepare_release(collect)
+    _switch_release()
+
+
+def rollback(to=''):
+    """
+    Points current back at the previous release, or at releases/<to>,
+    and reloads gunicorn
+    """
+    require('hosts')
+    if not _conf('releases'):
+        abort('rollback: turn on releases in GLUE_SETTINGS first')
+    _switch_release(to or 'previous')
+    gracefulreload()
+
+
+def _incremental(since='', full=''):
+    """
+    The since argument for _setowner()/_setperms(): None for a full walk,
+    otherwise since, or 'marker' when no revision is known
+    """
+    if full or not _conf('incremental_perms', True):
+        return None
+    return since or 'marker'
 
 
 def _success():
+    _trace_summary()
     print(green('----------------------------------------------------'))
     print(green('-- twined // All tasks finished!'))
 
@@ -388,11 +2689,114 @@ def tailgun(follow=''):
 
     with cd(env.path):
         if follow:
-            run('tail -f logs/gunicorn.log')
+            _run('tail -f logs/gunicorn.log')
         else:
-            run('tail logs/gunicorn.log')
+            _run('tail logs/gunicorn.log')
 
 
+def _stream_down(script):
+    """
+    Yields the lines script prints on the host, run as project_user and
+    sent gzipped over one ssh channel, unpacked as they arrive
+    """
+    _flush()
+    _round_trip()
+    with _span('stream', script.strip().splitlines()[-1][:80]) as event:
+        channel = connections[env.host_string].get_transport().open_session()
+        channel.exec_command('sudo -n -H -u "%s" /bin/sh -c "%s"' % (
+            env.project_user, _shell_script('( %s ) | gzip -1' % script)))
+        inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        rest = ''
+        while True:
+            data = channel.recv(1 << 16)
+            if not data:
+                break
+            event['bytes'] += len(data)
+            lines = (rest + inflater.decompress(data)).split('\n')
+            rest = lines.pop()
+            for line in lines:
+                yield line
+        rest += inflater.flush()
+        if rest:
+            yield rest
+        event['status'] = channel.recv_exit_status()
+        stderr = channel.recv_stderr(4096).strip()
+        if event['status']:
+            abort('stream: the host said (exit %s): %s' % (event['status'], stderr))
+        if stderr:
+            # e.g. sudo's "unable to resolve host", which doesn't matter
+            print(yellow('-- stream // the host said: %s' % stderr))
+
+
+def _last_deploy():
+    """
+    When the last update, restart or rollout of this flavor finished, from
+    history_file, or None
+    """
+    history_file = _conf('history_file', '')
+    if not history_file or not os.path.exists(history_file):
+        return None
+    # reload is what gracefulreload was called in older history
+    deploys = set(['update', 'restart', 'gracefulreload', 'reload', 'rollout', 'release'])
+    at = None
+    with open(history_file) as f:
+        for line in f:
+            run = line.strip() and json.loads(line)
+            if run and run['flavor'] == env.flavor and not run['failed'] and set(run['tasks']) & deploys:
+                at = run['at']
+    return at and time.mktime(time.strptime(at, '%Y-%m-%d %H:%M:%S'))
+
+
+def logstats(since='60', path='', compare='', top='15'):
+    """
+    Throughput, status mix and p50/p95/p99 latency per endpoint from the
+    access logs, over the last `since` minutes. compare=deploy (or minutes
+    ago) shows `since` minutes before and after that instead
+    """
+    require('hosts')
+    window = float(since) * 60
+    if compare:
+        split = compare == 'deploy' and _last_deploy() or None
+        if compare != 'deploy':
+            split = time.time() - float(compare) * 60
+        if not split:
+            abort('logstats: no deploy of %s recorded in history_file' % env.flavor)
+        start, end = split - window, min(split + window, time.time())
+    else:
+        split, start, end = None, time.time() - window, time.time()
+
+    logs = _conf('access_logs', ['logs/gunicorn.log*'])
+    script = 'cd "%s" && "%s/bin/python" -c "$(echo %s | base64 -d)" %d %d \'%s\' %s' % (
+        env.path, env.venv_path, base64.b64encode(_logstats.FILTER), start, end, path,
+        ' '.join("'%s'" % log for log in logs))
+    before = _logstats.Stats((split or end) - start)
+    after = _logstats.Stats(end - (split or start))
+    started, skipped = time.time(), 0
+    for line in _stream_down(script):
+        entry = _logstats.parse(line)
+        if entry is None:
+            skipped += 1
+        elif split and entry[0] < split:
+            before.add(entry)
+        else:
+            after.add(entry)
+    print(cyan('-- logstats // %d requests in %.1fs%s' % (
+        before.total + after.total, time.time() - started,
+        skipped and ', %d lines not understood' % skipped or '')))
+    if split:
+        print(cyan('-- logstats // %d minutes before and after %s' % (
+            (split - start) / 60, datetime.fromtimestamp(split).strftime('%Y-%m-%d %H:%M'))))
+        lines = _logstats.compare(before, after, int(top))
+    else:
+        lines = _logstats.report(after, int(top))
+    print(cyan(lines[0]))
+    for line in lines[1:]:
+        print(line)
+
+
+@_requires('deploy')
+@_inputs('conf/supervisord/%(flavor)s.conf')
+@_probes('/etc/supervisor/conf.d/%(procname)s.conf')
 def supervisorcfg():
     """
     Links our supervisor config file to the config.d dir
@@ -400,14 +2804,186 @@ def supervisorcfg():
     require('hosts')
     print(cyan('-- supervisorcfg // linking config file to conf.d/'))
     if not _exists('/etc/supervisor/conf.d/%s.conf' % (env.procname)):
-        sudo('ln -s %s/conf/supervisord/%s.conf /etc/supervisor/conf.d/%s.conf' % (env.path, env.flavor, env.procname))
+        link = True
     else:
+        link = False
         print(yellow('-- supervisorcfg // %s.conf already exists!' % (env.procname)))
 
-    sudo('supervisorctl reread')
-    sudo('supervisorctl update')
+    with _batch():
+        if link:
+            _sudo('ln -s %s/conf/supervisord/%s.conf /etc/supervisor/conf.d/%s.conf' % (env.path, env.flavor, env.procname))
+        _sudo('supervisorctl reread')
+        _sudo('supervisorctl update')
+
+
+_CAPACITY_SCRIPT = """
+echo "glue-capacity cores $(getconf _NPROCESSORS_ONLN)"
+awk '/^(MemTotal|MemAvailable|MemFree|Cached):/ { print "glue-capacity " $1 " " $2 }' /proc/meminfo
+echo "glue-capacity load $(cut -d ' ' -f 1-3 /proc/loadavg)"
+master=$(supervisorctl pid %(procname)s 2>/dev/null)
+case "$master" in
+    ''|*[!0-9]*) ;;
+    *) for pid in $(pgrep -P "$master"); do
+           echo "glue-capacity rss $(awk '/^VmRSS:/ { print $2 }' /proc/$pid/status)"
+       done ;;
+esac
+if [ -e "%(conf)s" ]; then sed 's/^/glue-conf /' "%(conf)s"; fi
+if [ -e "%(source)s" ]; then sed 's/^/glue-source /' "%(source)s"; fi
+"""
+
+# what sizeworkers sizes gunicorn by, overridden by gunicorn_policy
+_GUNICORN_POLICY = {
+    'workers_per_core': 2,
+    'min_workers': 2,
+    'max_workers': 16,
+    # share of the memory available (plus what the workers hold now) the
+    # workers may take, and their size when none are running to measure
+    'memory_fraction': 0.6,
+    'worker_rss_mb': 150,
+    # 'auto' makes up with threads for workers memory doesn't allow
+    'threads': 'auto',
+    'max_threads': 4,
+    # raised with the load, up to 3 times, on a host that is busy
+    'timeout': 30,
+}
+
+# gunicorn's spellings of the options sizeworkers sets
+_GUNICORN_OPTIONS = {
+    'workers': ('-w', '--workers'),
+    'threads': (None, '--threads'),
+    'timeout': ('-t', '--timeout'),
+    'worker-class': ('-k', '--worker-class'),
+}
+
+
+def _worker_class(conf):
+    """
+    The worker class conf's gunicorn command asks for, sync if none
+    """
+    for line in conf.splitlines():
+        if line.strip().startswith('command') and 'gunicorn' in line:
+            m = re.search(r'\s(?:-k\s*|--worker-class(?:=|\s+))(\S+)', line)
+            return m and m.group(1).replace('egg:gunicorn#', '') or 'sync'
+    abort('sizeworkers: no gunicorn command in the supervisor config')
 
 
+def _gunicorn_sizing(capacity, policy):
+    """
+    Workers, threads, timeout and worker class for a host's capacity
+    """
+    cores = capacity['cores']
+    rss = capacity['rss']
+    worker_mb = rss and sum(rss) / 1024.0 / len(rss) or policy['worker_rss_mb']
+    budget_mb = (capacity['MemAvailable'] + sum(rss)) / 1024.0 * policy['memory_fraction']
+    wanted = cores * policy['workers_per_core'] + 1
+    workers = max(policy['min_workers'], min(policy['max_workers'], wanted, int(budget_mb / worker_mb)))
+    threads = policy['threads']
+    if threads == 'auto':
+        threads = max(1, min(policy['max_threads'], -(-wanted // workers)))
+    busy = min(3.0, max(1.0, capacity['load'][2] / cores))
+    return {
+        'workers': workers,
+        'threads': int(threads),
+        'timeout': int(policy['timeout'] * busy),
+        'worker-class': int(threads) > 1 and 'gthread' or 'sync',
+    }
+
+
+def _sized_conf(conf, sizing):
+    """
+    conf with the options of its gunicorn command set to sizing
+    """
+    lines = conf.splitlines()
+    for i, line in enumerate(lines):
+        if line.strip().startswith('command') and 'gunicorn' in line:
+            for name, (short, option) in sorted(_GUNICORN_OPTIONS.items()):
+                line = re.sub(r'\s%s(?:=|\s+)\S+' % re.escape(option), '', line)
+                if short:
+                    line = re.sub(r'\s%s\s*\S+' % re.escape(short), '', line)
+                line += ' %s=%s' % (option, sizing[name])
+            lines[i] = line
+            return '\n'.join(lines) + '\n'
+    abort('sizeworkers: no gunicorn command in the supervisor config')
+
+
+def sizeworkers(apply=''):
+    """
+    Sizes gunicorn's workers, threads and timeout to the host's cores,
+    memory, worker size and load, and shows the change to the supervisor
+    config. apply=yes applies it without asking, apply=no only shows it
+    """
+    require('hosts')
+    conf = '/etc/supervisor/conf.d/%s.conf' % env.procname
+    print(cyan('-- sizeworkers // measuring the host'))
+    with _settings(hide('running', 'stdout')):
+        result = _sudo(_shell_script(_CAPACITY_SCRIPT % {
+            'procname': env.procname, 'conf': conf,
+            'source': '%s/conf/supervisord/%s.conf' % (env.path, env.flavor)}))
+    capacity, current, source = {'rss': []}, [], []
+    for line in result.splitlines():
+        if line.startswith('glue-conf '):
+            current.append(line[len('glue-conf '):])
+        elif line.startswith('glue-source '):
+            source.append(line[len('glue-source '):])
+        elif line.startswith('glue-capacity '):
+            fields = line.split()[1:]
+            key = fields[0].rstrip(':')
+            if key == 'rss':
+                capacity['rss'].extend(int(f) for f in fields[1:])
+            elif key == 'load':
+                capacity['load'] = [float(f) for f in fields[1:]]
+            else:
+                capacity[key] = int(fields[1])
+    if not current:
+        abort('sizeworkers: %s is missing, run supervisorcfg first' % conf)
+    # kernels before 3.14 don't estimate what is available
+    if 'MemAvailable' not in capacity:
+        capacity['MemAvailable'] = capacity['MemFree'] + capacity.get('Cached', 0)
+
+    # the policy only knows sync and gthread workers; gevent, eventlet and
+    # the like are sized by their own rules and left alone
+    source = source and '\n'.join(source) + '\n'
+    worker_class = _worker_class(source or '\n'.join(current))
+    if worker_class not in ('sync', 'gthread'):
+        print(yellow('-- sizeworkers // %s uses %s workers, which are not sized' % (
+            env.procname, worker_class)))
+        return
+    policy = dict(_GUNICORN_POLICY, **_conf('gunicorn_policy', {}))
+    sizing = _gunicorn_sizing(capacity, policy)
+    print(cyan('-- sizeworkers // %d cores, %d of %d MB available, load %.2f, %d worker(s) of %s MB' % (
+        capacity['cores'], capacity['MemAvailable'] / 1024, capacity['MemTotal'] / 1024,
+        capacity['load'][2], len(capacity['rss']),
+        capacity['rss'] and '%.0f' % (sum(capacity['rss']) / 1024.0 / len(capacity['rss'])) or '?')))
+    print(cyan('-- sizeworkers // %(workers)d workers x %(threads)d threads (%(worker-class)s), '
+               'timeout %(timeout)ds' % sizing))
+
+    # sized from the checkout's config, so changes to it are picked up
+    current = '\n'.join(current) + '\n'
+    sized = _sized_conf(source or current, sizing)
+    if sized == current:
+        print(green('-- sizeworkers // the config already matches'))
+        return
+    for line in difflib.unified_diff(current.splitlines(), sized.splitlines(),
+                                     conf, '%s (sized)' % conf, lineterm=''):
+        print(line.startswith('+') and green(line) or line.startswith('-') and red(line) or line)
+    if apply == 'no' or (apply != 'yes' and prompt('Apply and restart %s? [y/N]' % env.procname,
+                                                   default='n').lower() not in ('y', 'yes')):
+        return
+
+    # the sized config is kept next to glue's other state and linked in
+    # place of the checkout's, whose other settings it keeps
+    target = _state_path('supervisor.conf')
+    with _batch():
+        _sudo(_shell_script('mkdir -p "%s" && echo %s | base64 -d > "%s" && ln -sfn "%s" "%s"' % (
+            os.path.dirname(target), base64.b64encode(sized), target, target, conf)))
+        _sudo('supervisorctl reread')
+        _sudo('supervisorctl update')
+    print(green('-- sizeworkers // %s is now sized, supervisor updated' % env.procname))
+
+
+@_requires('deploy')
+@_inputs('conf/nginx/%(flavor)s.conf')
+@_probes('/etc/nginx/sites-enabled/%(procname)s', '%(path)s/logs/nginx')
 def nginxcfg():
     """
     Links our nginx config to the sites-enabled dir
@@ -415,39 +2991,44 @@ def nginxcfg():
     require('hosts')
     print(cyan('-- nginxcfg // linking config file to conf.d/'))
     if not _exists('/etc/nginx/sites-enabled/%s' % (env.procname)):
-        sudo('ln -s %s/conf/nginx/%s.conf /etc/nginx/sites-enabled/%s' % (env.path, env.flavor, env.procname))
+        _sudo('ln -s %s/conf/nginx/%s.conf /etc/nginx/sites-enabled/%s' % (env.path, env.flavor, env.procname))
     else:
         print(yellow('-- nginxcfg // %s already exists!' % env.procname))
     print(cyan('-- nginxcfg // make sure our log directories exist!'))
     if not _exists('%s/logs/nginx' % env.path):
-        sudo('mkdir -p %s/logs/nginx' % env.path, user=env.project_user)
+        _sudo('mkdir -p %s/logs/nginx' % env.path, user=env.project_user)
     else:
         print(yellow('-- nginxcfg // %s/logs already exists!' % (env.path)))
     print(cyan('-- nginxcfg // reloading nginx config'))
-    sudo('/etc/init.d/nginx reload')
+    _sudo('/etc/init.d/nginx reload')
 
 
+@_requires('deploy')
+@_inputs('etc/logrotate/%(flavor)s.conf')
 def logrotatecfg():
     """
     Links our logrotate config file to the config.d dir
     """
     require('hosts')
     logrotate_src = "%s/etc/logrotate/%s.conf" % (env.path, env.flavor)
-    print(cyan('-- logrotateconf // linking config file to conf.d/'))
-    if not _exists('/etc/logrotate.d/%s.conf' % (env.procname)):
-        sudo('ln -s %s /etc/logrotate.d/%s.conf' % (logrotate_src, env.procname))
-    else:
-        print(yellow('-- logrotateconf // %s.conf already exists!' % (env.procname)))
+    with _batch():
+        # test on the host instead of calling _exists(), so the link can
+        # be sent along with the rest of the batch
+        print(cyan('-- logrotateconf // linking config file to conf.d/ (if missing)'))
+        _sudo('test -e /etc/logrotate.d/%s.conf || ln -s %s /etc/logrotate.d/%s.conf' % (
+            env.procname, logrotate_src, env.procname))
 
-    # set permission to 644
-    print(cyan('-- setperms // setting logrotate conf to 644'))
-    sudo('chmod %s "%s"' % (perms, logrotate_src))
+        # set permission to 644
+        print(cyan('-- setperms // setting logrotate conf to 644'))
+        _sudo('chmod %s "%s"' % ('644', logrotate_src))
 
-    # set owner to root
-    print(cyan('-- setowner // setting logrotate owner to root'))
-    sudo('chown root:wheel "%s"' % logrotate_src)
+        # set owner to root
+        print(cyan('-- setowner // setting logrotate owner to root'))
+        _sudo('chown root:wheel "%s"' % logrotate_src)
 
 
+@_inputs('%(project_user)s', '%(project_group)s')
+@_probes('user:%(project_user)s')
 def createuser():
     """
     Creates a linux user on host, if it doesn't already exists
@@ -455,20 +3036,21 @@ def createuser():
     """
     require('hosts')
     with _settings(warn_only=True):
-        output = sudo('id %s' % env.project_user)
-        if output.failed:
+        if not _user_exists(env.project_user):
             # no such user, create it.
-            sudo('adduser %s' % env.project_user)
-            sudo('usermod -a -G %s %s' % (env.project_group, env.project_user))
-            output = sudo('id %s' % env.project_user)
+            _sudo('adduser %s' % env.project_user)
+            _sudo('usermod -a -G %s %s' % (env.project_group, env.project_user))
+            output = _sudo('id %s' % env.project_user)
             if output.failed:
                 abort('createuser: ERROR: could not create user!')
+            _fact('user:%s' % env.project_user, True)
         else:
             print(yellow('-- createuser // user %s already exists.' % env.project_user))
         print(cyan('-- createuser // add to group'))
-        sudo('usermod -a -G %s %s' % (env.project_group, env.project_user))
+        _sudo('usermod -a -G %s %s' % (env.project_group, env.project_user))
 
 
+@_inputs('%(db_name)s', '%(db_user)s')
 def createdb():
     """
     Creates pgsql role and database
@@ -476,7 +3058,7 @@ def createdb():
     require('hosts')
     with _settings(warn_only=True):
         print(cyan('-- createdb // creating user %s' % env.db_user))
-        result = sudo('psql -c "CREATE USER %s WITH NOCREATEDB NOCREATEUSER ENCRYPTED PASSWORD \'%s\';"' % (env.db_user, env.db_pass), user='postgres')
+        result = _sudo('psql -c "CREATE USER %s WITH NOCREATEDB NOCREATEUSER ENCRYPTED PASSWORD \'%s\';"' % (env.db_user, env.db_pass), user='postgres')
         if result.failed:
             if 'already exists' in result:
                 print(yellow('-- createdb // user already exists'))
@@ -484,7 +3066,7 @@ def createdb():
                 abort(red('-- createdb // error in user creation!'))
 
         print(cyan('-- createdb // creating db %s with owner %s' % (env.db_name, env.db_user)))
-        result = sudo('psql -c "CREATE DATABASE %s WITH OWNER %s ENCODING \'UTF-8\'";' % (
+        result = _sudo('psql -c "CREATE DATABASE %s WITH OWNER %s ENCODING \'UTF-8\'";' % (
             env.db_name, env.db_user), user='postgres')
 
         if result.failed:
@@ -494,21 +3076,26 @@ def createdb():
                 abort(red('-- createdb // error in db creation!'))
 
 
+@_requires('createuser')
+@_inputs('%(repo)s', '%(branch)s')
+@_probes('%(path)s')
 def deploy():
     """
     Clone the git repository to the correct directory
     """
     require('hosts')
+    if _conf('releases'):
+        return release(collect='')
     if not _exists(env.path):
         print(cyan('-- creating %s as %s' % (env.path, env.project_user)))
-        sudo('mkdir -p %s' % env.path, user=env.project_user)
+        _sudo('mkdir -p %s' % env.path, user=env.project_user)
         with cd(env.path):
             if (getattr(env, 'branch', '') == ''):
                 print(cyan('-- git // cloning source code into %s' % env.path))
-                sudo('git clone file:///code/git/%s .' % env.repo, user=env.project_user)
+                _sudo('git clone file:///code/git/%s .' % env.repo, user=env.project_user)
             else:
                 print(cyan('-- git // cloning source code branch %s into %s' % (env.branch, env.path)))
-                sudo('git clone file:///code/git/%s -b %s .' % (env.repo, env.branch), user=env.project_user)
+                _sudo('git clone file:///code/git/%s -b %s .' % (env.repo, env.branch), user=env.project_user)
         fixprojectperms()
     else:
         print(cyan('-- directory %s exists, skipping git clone & updating instead' % env.path))
@@ -520,41 +3107,225 @@ def clear():
     """
 
 
-def installreqs():
-    "Install the required packages from the requirements file using pip"
+def _requirements_hash(path, seen=None):
+    """
+    Hashes a requirements file together with the files it pulls in
+    with -r or -c
+    """
+    seen = seen if seen is not None else set()
+    digest = hashlib.sha1()
+    path = os.path.normpath(path)
+    if path in seen:
+        return ''
+    seen.add(path)
+    with open(path) as f:
+        for line in f:
+            digest.update(line)
+            words = line.split()
+            if len(words) == 2 and words[0] in ('-r', '-c', '--requirement', '--constraint'):
+                digest.update(_requirements_hash(
+                    os.path.join(os.path.dirname(path), words[1]), seen))
+    return digest.hexdigest()
+
+
+def _build_wheels(requirements, digest):
+    """
+    Builds the wheels for requirements into the local wheelhouse, once per
+    requirements hash. Returns the directory holding them
+    """
+    path = os.path.join(_conf('wheelhouse', ''), digest)
+    if os.path.exists(os.path.join(path, '.complete')):
+        print(cyan('-- installreqs // wheels for %s already built' % digest[:10]))
+        return path
+    print(cyan('-- installreqs // building wheels into %s' % path))
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    local('%s -r %s -w %s' % (_conf('wheel_command', 'pip wheel -q'), requirements, path))
+    # pins what was built, so the host installs exactly these wheels
+    pins = []
+    for name in sorted(os.listdir(path)):
+        if name.endswith('.whl'):
+            pins.append('%s==%s' % tuple(name.split('-')[:2]))
+    with open(os.path.join(path, 'requirements.txt'), 'w') as f:
+        f.write('\n'.join(pins) + '\n')
+    open(os.path.join(path, '.complete'), 'w').close()
+    return path
+
+
+def _ship_wheels(path, digest, shipped):
+    """
+    Uploads the wheels in path the host's wheelhouse does not have yet,
+    with the pinned requirements, as one tarball
+    """
+    wheelhouse = os.path.join(env.venv_root, '.wheelhouse')
+    missing = [name for name in os.listdir(path)
+               if name.endswith('.whl') and name not in shipped]
+    print(cyan('-- installreqs // shipping %d of %d wheels' % (
+        len(missing), len([n for n in os.listdir(path) if n.endswith('.whl')]))))
+    handle, tarball = tempfile.mkstemp(suffix='.tar')
+    os.close(handle)
+    try:
+        with tarfile.open(tarball, 'w') as tar:
+            for name in missing:
+                tar.add(os.path.join(path, name), name)
+            tar.add(os.path.join(path, 'requirements.txt'), '%s.txt' % digest)
+        remote = '/tmp/glue-wheels-%s.tar' % digest[:10]
+        _put(tarball, remote, use_sudo=True)
+    finally:
+        os.remove(tarball)
+    with _batch():
+        _sudo('mkdir -p %s && tar -xf %s -C %s && rm -f %s' % (wheelhouse, remote, wheelhouse, remote))
+        _sudo('chown -R %s:%s %s' % (env.project_user, env.project_group, wheelhouse))
+    return wheelhouse
+
+
+@_requires('deploy', 'mkvirtualenv')
+@_inputs('requirements/%(flavor)s.pip')
+def installreqs(force=''):
+    """
+    Install the required packages from the requirements file using pip.
+    With wheelhouse set, the wheels are built locally and preferred on the
+    host (the index still serves what has no matching wheel), and nothing
+    is done while the requirements hash matches the one recorded in the
+    virtualenv
+    """
     require('hosts')
-    with cd(env.path):
-        sudo('export WORKON_HOME=/sites/.virtualenvs && source /usr/local/bin/virtualenvwrapper.sh && workon %s && pip install -r ./requirements/%s.pip' % (
-            env.venv_name, env.flavor), user=env.project_user)
+    workon = 'export WORKON_HOME=/sites/.virtualenvs && source /usr/local/bin/virtualenvwrapper.sh && workon %s' % env.venv_name
+    requirements = 'requirements/%s.pip' % env.flavor
+    digest = _requirements_hash(requirements)
+    # what is installed, which migrate, syncdb and collectstatic look at
+    marker = os.path.join(env.venv_path, '.glue-requirements')
+    if not _conf('wheelhouse', ''):
+        with cd(env.path):
+            _sudo('%s && pip install -r ./%s && echo %s > %s' % (
+                workon, requirements, digest, marker), user=env.project_user)
+        return
+    with _settings(hide('stdout')):
+        state = _sudo('cat %s 2>/dev/null; echo --; ls -1 %s 2>/dev/null; true' % (
+            marker, os.path.join(env.venv_root, '.wheelhouse')))
+    recorded, _, shipped = state.partition('--')
+    if recorded.strip() == digest and not force:
+        print(green('-- installreqs // requirements unchanged (%s), skipping' % digest[:10]))
+        return
+    wheelhouse = _ship_wheels(_build_wheels(requirements, digest), digest,
+                              set(shipped.split()))
+    print(cyan('-- installreqs // installing from the wheelhouse'))
+    # with the index, so wheels built for another platform fall back to it
+    _sudo('%s && pip install --find-links=%s -r %s/%s.txt && echo %s > %s' % (
+        workon, wheelhouse, wheelhouse, digest, digest, marker), user=env.project_user)
+
+
+# cache clients per (kind, host), kept for the run
+_CACHE_CLIENTS = {}
+
+
+def _cache_client(kind):
+    """
+    A pooled glue.cache client for the host's redis or memcached, reached
+    through the ssh connection (direct-tcpip), so the port needn't be open
+    """
+    key = (kind, env.host_string)
+    if key not in _CACHE_CLIENTS:
+        address = (_conf('%s_host' % kind, '127.0.0.1'),
+                   int(_conf('%s_port' % kind, kind == 'redis' and 6379 or 11211)))
+
+        def connect():
+            _round_trip()
+            transport = connections[env.host_string].get_transport()
+            return transport.open_channel('direct-tcpip', address, ('127.0.0.1', 0))
+        client = kind == 'redis' and cache.Redis or cache.Memcached
+        _CACHE_CLIENTS[key] = client(connect)
+    return _CACHE_CLIENTS[key]
 
 
 def flushmemcached():
     "Flush memcached"
     print(cyan('-- memcached // flushing cache'))
-    run('echo flush_all | nc 127.0.0.1 11211')
+    _cache_client('memcached').flush_all()
+
+
+def memcached_increase_gen():
+    "Increase memcached global gen key"
+    if not _conf('memcached_gen_key'):
+        abort('memcached_increase_gen: set memcached_gen_key in GLUE_SETTINGS')
+    generation = _cache_client('memcached').incr(_conf('memcached_gen_key'))
+    print(green('-- memcached // %s is now %s' % (_conf('memcached_gen_key'), generation)))
 
 
 def redis_increase_gen():
     "Increase redis global gen key"
-    # run ./manage.py incr_gen?
-    # run('echo INCR %s | nc 127.0.0.1 6379' % env.redis_key)
+    if not env.redis_key:
+        abort('redis_increase_gen: set redis_key in GLUE_SETTINGS')
+    generation = _cache_client('redis').incr(env.redis_key)
+    print(green('-- redis // %s is now %s' % (env.redis_key, generation)))
 
 
 def nginxreload():
     "Reloads nginxs configuration"
     print(cyan('-- nginx // reloading'))
-    sudo('/etc/init.d/nginx reload')
+    _sudo('/etc/init.d/nginx reload')
 
 
 def nginxrestart():
     "Restarts nginxs configuration"
     print(cyan('-- nginx // restarting'))
-    sudo('/etc/init.d/nginx restart')
-
-
-def searchreindex():
-    "Rebuild Haystack search index"
+    _sudo('/etc/init.d/nginx restart')
+
+
+# runs update_index for what changed since the start of the last run
+# recorded in $state, or rebuild_index without one, then records when
+# this run started
+_SEARCH_INDEX_SCRIPT = """
+set -e
+cd "%(path)s"
+state="%(state)s"
+mkdir -p "$(dirname "$state")"
+started=$(date +%%Y-%%m-%%dT%%H:%%M:%%S)
+if [ -n "%(full)s" ] || [ ! -s "$state" ]; then
+    echo "glue-search full"
+    FLAVOR=%(flavor)s "%(venv_path)s/bin/python" manage.py rebuild_index --noinput %(options)s
+else
+    echo "glue-search since $(cat "$state")"
+    FLAVOR=%(flavor)s "%(venv_path)s/bin/python" manage.py update_index --start="$(cat "$state")" %(options)s %(remove)s
+fi
+echo "$started" > "$state"
+"""
+
+
+@_requires('gitpull', 'release', 'migrate')
+@_inputs(_deployed_revision)
+def searchreindex(full='', primary=''):
+    """
+    Updates the Haystack search index with the objects changed since the
+    last run, search_workers processes at a time. full=yes rebuilds it.
+    The index is shared, so only primary (the first host by default)
+    indexes
+    """
     require('hosts')
-    with cd(env.path):
-        print(cyan('-- searchreindex // rebuilding haystack index'))
-        sudo("%s/bin/python manage.py rebuild_index" % env.venv_path, user=env.project_user)
+    if env.host_string != (primary or env.hosts[0]):
+        print(cyan('-- searchreindex // %s keeps the index up to date, skipped here' % (
+            primary or env.hosts[0])))
+        return
+    started = time.time()
+    print(cyan('-- searchreindex // %s haystack index' % (full and 'rebuilding' or 'updating')))
+    options = '--workers=%d --batch-size=%d' % (
+        int(_conf('search_workers', 4)), int(_conf('search_batch_size', 1000)))
+    _own_state_dir()
+    result = _sudo(_shell_script(_SEARCH_INDEX_SCRIPT % {
+        'path': env.path, 'state': _state_path('search-index'), 'full': full and 'yes' or '',
+        'flavor': env.flavor, 'venv_path': env.venv_path, 'options': options,
+        'remove': _conf('search_remove') and '--remove' or '',
+    }), user=env.project_user)
+    since = [l[len('glue-search since '):] for l in result.splitlines() if l.startswith('glue-search since ')]
+    print(green('-- searchreindex // %s in %.1fs' % (
+        since and 'indexed changes since %s' % since[0] or 'rebuilt the index', time.time() - started)))
+
+
+atexit.register(_write_trace)
+
+# every glue task (and the private pipeline steps) records a trace event
+for _name, _task in list(globals().items()):
+    if (getattr(_task, '__module__', None) == __name__ and callable(_task)
+            and not isinstance(_task, type)
+            and (not _name.startswith('_') or hasattr(_task, 'glue_requires'))):
+        globals()[_name] = _traced(_task)
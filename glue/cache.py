@@ -0,0 +1,159 @@
+"""
+Minimal redis and memcached clients for bumping cache generations from a
+deploy, without shelling out to nc on the host.
+
+Both take a connect function returning a socket-like object (sendall(),
+recv(), close()): a tcp socket, or an ssh channel forwarded to the host's
+local port, see glue.bottle. Connections are pooled per client.
+"""
+import socket
+from Queue import LifoQueue, Empty
+
+
+class CacheError(Exception):
+    pass
+
+
+def tcp(host, port, timeout=5):
+    """
+    A connect function for a plain tcp connection, e.g. to a local redis
+    or memcached
+    """
+    return lambda: socket.create_connection((host, port), timeout)
+
+
+class _Connection(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = ''
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def line(self):
+        while '\r\n' not in self.buffer:
+            self.fill()
+        line, self.buffer = self.buffer.split('\r\n', 1)
+        return line
+
+    def read(self, length):
+        while len(self.buffer) < length + 2:
+            self.fill()
+        data, self.buffer = self.buffer[:length], self.buffer[length + 2:]
+        return data
+
+    def fill(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise CacheError('connection closed')
+        self.buffer += data
+
+    def close(self):
+        self.sock.close()
+
+
+class _Client(object):
+    def __init__(self, connect, pool_size=4):
+        self.connect = connect
+        self.pool = LifoQueue(pool_size)
+
+    def call(self, request, reply):
+        """
+        Sends request on a pooled connection and returns reply(connection).
+        A connection that failed is dropped instead of going back
+        """
+        try:
+            connection = self.pool.get_nowait()
+        except Empty:
+            connection = _Connection(self.connect())
+        try:
+            connection.send(request)
+            result = reply(connection)
+        except Exception:
+            connection.close()
+            raise
+        if self.pool.full():
+            connection.close()
+        else:
+            self.pool.put_nowait(connection)
+        return result
+
+    def close(self):
+        while not self.pool.empty():
+            self.pool.get_nowait().close()
+
+
+class Redis(_Client):
+    """
+    Speaks enough RESP for simple commands
+    """
+    def execute(self, *args):
+        request = '*%d\r\n' % len(args) + ''.join(
+            '$%d\r\n%s\r\n' % (len(str(arg)), arg) for arg in args)
+        result = self.call(request, self._reply)
+        if isinstance(result, CacheError):
+            raise result
+        return result
+
+    def _reply(self, connection):
+        line = connection.line()
+        kind, rest = line[:1], line[1:]
+        if kind == '+':
+            return rest
+        if kind == '-':
+            # returned, not raised: the connection is still good
+            return CacheError(rest)
+        if kind == ':':
+            return int(rest)
+        if kind == '$':
+            return None if rest == '-1' else connection.read(int(rest))
+        if kind == '*':
+            return None if rest == '-1' else [self._reply(connection) for _ in range(int(rest))]
+        raise CacheError('unexpected reply %r' % line)
+
+    def incr(self, key):
+        return self.execute('INCR', key)
+
+    def get(self, key):
+        return self.execute('GET', key)
+
+
+class Memcached(_Client):
+    """
+    Speaks enough of the memcached text protocol for counters
+    """
+    def command(self, line, data=None):
+        request = line + '\r\n' + (data is not None and data + '\r\n' or '')
+        return self.call(request, lambda connection: connection.line())
+
+    def incr(self, key, initial=1):
+        """
+        Increments key, creating it (without expiry) at initial if missing
+        """
+        for _ in range(2):
+            reply = self.command('incr %s 1' % key)
+            if reply.isdigit():
+                return int(reply)
+            if reply != 'NOT_FOUND':
+                raise CacheError(reply)
+            # lost races to another deploy's add() are fine, incr again
+            if self.command('add %s 0 0 %d' % (key, len(str(initial))), str(initial)) == 'STORED':
+                return initial
+        raise CacheError('could not increment %s' % key)
+
+    def get(self, key):
+        def reply(connection):
+            line = connection.line()
+            if line == 'END':
+                return None
+            if not line.startswith('VALUE '):
+                raise CacheError(line)
+            value = connection.read(int(line.split()[3]))
+            connection.line()
+            return value
+        return self.call('get %s\r\n' % key, reply)
+
+    def flush_all(self):
+        reply = self.command('flush_all')
+        if reply != 'OK':
+            raise CacheError(reply)
@@ -0,0 +1,171 @@
+"""
+Summarises access logs in gunicorn's or nginx's combined format, with the
+request time as the last field: gunicorn's %(L)s (seconds) or %(D)s
+(microseconds), or nginx's $request_time. Lines without it still count
+towards throughput and status mix.
+
+FILTER runs on the host (python 2 or 3) and passes on only the lines of a
+time window and path prefix, so the rest never crosses the wire; Stats
+takes the lines one at a time as they arrive, see glue.bottle.logstats.
+"""
+import calendar
+import re
+
+
+FILTER = r'''
+import calendar, glob, gzip, os, re, sys
+since, until, prefix = float(sys.argv[1]), float(sys.argv[2]), sys.argv[3].encode('latin-1')
+stamp = re.compile(br'\[(\d\d)/(\w\w\w)/(\d{4}):(\d\d):(\d\d):(\d\d) ([+-])(\d\d)(\d\d)\]')
+request = re.compile(br'"[A-Z]+ (\S+)')
+months = dict((m, i + 1) for i, m in enumerate(
+    b'Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec'.split()))
+out = getattr(sys.stdout, 'buffer', sys.stdout)
+for pattern in sys.argv[4:]:
+    for path in sorted(glob.glob(pattern)):
+        if os.path.getmtime(path) < since:
+            continue
+        with (gzip.open if path.endswith('.gz') else open)(path, 'rb') as f:
+            for line in f:
+                m = stamp.search(line)
+                if not m:
+                    continue
+                g = m.groups()
+                t = calendar.timegm((int(g[2]), months.get(g[1], 1), int(g[0]),
+                                     int(g[3]), int(g[4]), int(g[5])))
+                t -= (g[6] == b'-' and -1 or 1) * (int(g[7]) * 3600 + int(g[8]) * 60)
+                if t < since or t >= until:
+                    continue
+                if prefix:
+                    r = request.search(line)
+                    if not r or not r.group(1).startswith(prefix):
+                        continue
+                out.write(line)
+'''
+
+_LINE = re.compile(
+    r'\[(?P<day>\d\d)/(?P<month>\w\w\w)/(?P<year>\d{4}):(?P<hour>\d\d):(?P<minute>\d\d):'
+    r'(?P<second>\d\d) (?P<sign>[+-])(?P<tzh>\d\d)(?P<tzm>\d\d)\] '
+    r'"(?P<method>[A-Z]+) (?P<path>\S+)[^"]*" (?P<status>\d{3}) ')
+_DURATION = re.compile(r'\s(\d+(?:\.\d+)?)\s*$')
+_MONTHS = dict((m, i + 1) for i, m in enumerate(
+    'Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec'.split()))
+# path segments that are ids rather than part of the endpoint
+_ID = re.compile(r'^(\d+|[0-9a-f]{8,}|[0-9a-f]{8}-[0-9a-f-]{27})$', re.I)
+
+
+def parse(line):
+    """
+    (time, method, endpoint, status, seconds or None) for an access log
+    line, or None if it isn't one
+    """
+    m = _LINE.search(line)
+    if not m:
+        return None
+    g = m.groupdict()
+    at = calendar.timegm((int(g['year']), _MONTHS.get(g['month'], 1), int(g['day']),
+                          int(g['hour']), int(g['minute']), int(g['second'])))
+    at -= (g['sign'] == '-' and -1 or 1) * (int(g['tzh']) * 3600 + int(g['tzm']) * 60)
+    seconds = None
+    duration = _DURATION.search(line[m.end():])
+    if duration:
+        value = duration.group(1)
+        seconds = float(value) if '.' in value else int(value) / 1e6
+    return at, g['method'], endpoint(g['path']), int(g['status']), seconds
+
+
+def endpoint(path):
+    """
+    The path without its query string, and with ids replaced by :id, so
+    /articles/12/ and /articles/13/ count together
+    """
+    path = path.split('?', 1)[0]
+    return '/'.join(_ID.match(s) and ':id' or s for s in path.split('/'))
+
+
+def percentile(values, fraction):
+    """
+    The value below which fraction of the (sorted) values fall
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Stats(object):
+    """
+    Counts, status classes and request times per endpoint, for a window
+    of `seconds`
+    """
+    def __init__(self, seconds):
+        self.seconds = max(seconds, 1)
+        self.endpoints = {}
+        self.total = 0
+
+    def add(self, entry):
+        at, method, path, status, seconds = entry
+        key = '%s %s' % (method, path)
+        if key not in self.endpoints:
+            self.endpoints[key] = {'count': 0, 'statuses': {}, 'times': []}
+        stats = self.endpoints[key]
+        stats['count'] += 1
+        stats['statuses'][status // 100] = stats['statuses'].get(status // 100, 0) + 1
+        if seconds is not None:
+            stats['times'].append(seconds)
+        self.total += 1
+
+    def row(self, key):
+        """
+        Requests per second, share of 4xx and 5xx, and p50/p95/p99 of key
+        """
+        stats = self.endpoints.get(key)
+        if not stats:
+            return None
+        times = sorted(stats['times'])
+        return {
+            'count': stats['count'],
+            'rate': stats['count'] / float(self.seconds),
+            '4xx': stats['statuses'].get(4, 0) / float(stats['count']),
+            '5xx': stats['statuses'].get(5, 0) / float(stats['count']),
+            'p50': percentile(times, 0.5),
+            'p95': percentile(times, 0.95),
+            'p99': percentile(times, 0.99),
+        }
+
+    def busiest(self, top):
+        return sorted(self.endpoints, key=lambda k: -self.endpoints[k]['count'])[:top]
+
+
+def _ms(seconds):
+    return seconds is None and '-' or '%.0fms' % (seconds * 1000)
+
+
+def report(stats, top=15):
+    """
+    Lines of a table of the top busiest endpoints
+    """
+    lines = ['%-44s %7s %7s %5s %5s %7s %7s %7s' % (
+        'endpoint', 'count', 'req/s', '4xx', '5xx', 'p50', 'p95', 'p99')]
+    for key in stats.busiest(top):
+        row = stats.row(key)
+        lines.append('%-44s %7d %7.2f %4.0f%% %4.0f%% %7s %7s %7s' % (
+            key[:44], row['count'], row['rate'], row['4xx'] * 100, row['5xx'] * 100,
+            _ms(row['p50']), _ms(row['p95']), _ms(row['p99'])))
+    return lines
+
+
+def compare(before, after, top=15):
+    """
+    Lines of a table of how the busiest endpoints changed between two
+    windows: request rate, share of 5xx and p50/p95
+    """
+    lines = ['%-44s %15s %13s %17s %17s' % ('endpoint', 'req/s', '5xx', 'p50', 'p95')]
+    keys = after.busiest(top)
+    keys += [k for k in before.busiest(top) if k not in keys]
+    for key in keys:
+        old, new = before.row(key) or {}, after.row(key) or {}
+        cells = ['%6.2f > %6.2f' % (old.get('rate', 0), new.get('rate', 0)),
+                 '%4.0f%% > %4.0f%%' % (old.get('5xx', 0) * 100, new.get('5xx', 0) * 100)]
+        for name in ('p50', 'p95'):
+            cells.append('%7s > %7s' % (_ms(old.get(name)), _ms(new.get(name))))
+        lines.append('%-44s %s %s %s %s' % tuple([key[:44]] + cells))
+    return lines
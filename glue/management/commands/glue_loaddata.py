@@ -0,0 +1,210 @@
+import gzip
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from optparse import make_option
+
+from django.core import serializers
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.db.models import get_model
+
+
+# whitespace, commas and the opening bracket between the objects of the array
+_SEPARATORS = re.compile(r'[\s,\[]*')
+
+
+def _objects(path):
+    """
+    Yields the objects of a dumpdata json array one at a time, reading the
+    file in chunks, so only one object is held in memory
+    """
+    opener = path.endswith('.gz') and gzip.open or open
+    decoder = json.JSONDecoder()
+    buf, pos = '', 0
+    with opener(path, 'rb') as f:
+        while True:
+            chunk = f.read(1 << 16)
+            buf = buf[pos:] + chunk
+            pos = 0
+            while True:
+                pos = _SEPARATORS.match(buf, pos).end()
+                if pos == len(buf) or buf[pos] == ']':
+                    break
+                try:
+                    obj, pos = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    if not chunk:
+                        raise CommandError('%s: truncated or invalid json near %r' % (
+                            path, buf[pos:pos + 80]))
+                    break
+                yield obj
+            if not chunk:
+                return
+
+
+def _levels(labels):
+    """
+    Groups model labels so that each model only points (by foreign key or
+    many to many) at models in earlier groups. Models in a cycle end up
+    together in the last group
+    """
+    requires = {}
+    for label in labels:
+        model = get_model(*label.split('.'))
+        targets = set()
+        for field in model._meta.fields + model._meta.many_to_many:
+            if field.rel:
+                target = field.rel.to._meta
+                targets.add('%s.%s' % (target.app_label, target.object_name.lower()))
+        requires[label] = targets & set(labels) - set([label])
+    levels, done = [], set()
+    while len(done) < len(labels):
+        level = sorted(l for l in labels if l not in done and requires[l] <= done)
+        if not level:
+            levels.append(sorted(l for l in labels if l not in done))
+            break
+        levels.append(level)
+        done.update(level)
+    return levels
+
+
+if hasattr(transaction, 'atomic'):
+    _atomic = transaction.atomic
+else:
+    _atomic = transaction.commit_on_success
+
+
+class Command(BaseCommand):
+    help = ('Loads a large dumpdata json fixture (optionally gzipped) with bounded memory: '
+            'objects are spooled per model, then bulk inserted model by model in '
+            'dependency order. No signals are sent.')
+    args = 'fixture'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+                    help='Objects per bulk insert.'),
+        make_option('--workers', dest='workers', type='int', default=1,
+                    help='Models loaded at once, among models that do not depend on each other.'),
+        make_option('--database', dest='database', default=DEFAULT_DB_ALIAS,
+                    help='Database to load into.'),
+    )
+
+    def handle(self, *fixtures, **options):
+        if len(fixtures) != 1:
+            raise CommandError('Give exactly one fixture file.')
+        self.batch_size = options.get('batch_size') or 1000
+        self.database = options.get('database') or DEFAULT_DB_ALIAS
+        self.verbosity = int(options.get('verbosity', 1))
+        started = time.time()
+        spool = tempfile.mkdtemp(prefix='glue-loaddata-')
+        try:
+            counts = self.spool(fixtures[0], spool)
+            levels = _levels(list(counts))
+            for level in levels:
+                self.load_level(level, spool, counts, max(1, options.get('workers') or 1))
+            self.reset_sequences(counts)
+        finally:
+            shutil.rmtree(spool)
+        self.stdout.write('Loaded %d objects of %d models in %.1fs\n' % (
+            sum(counts.values()), len(counts), time.time() - started))
+
+    def spool(self, path, spool):
+        """
+        Splits the fixture into one json lines file per model
+        """
+        files, counts = {}, {}
+        try:
+            for obj in _objects(path):
+                label = obj['model'].lower()
+                if label not in files:
+                    if get_model(*label.split('.')) is None:
+                        raise CommandError('Unknown model %s in %s' % (label, path))
+                    files[label] = open(os.path.join(spool, label), 'wb')
+                    counts[label] = 0
+                files[label].write(json.dumps(obj) + '\n')
+                counts[label] += 1
+        finally:
+            for f in files.values():
+                f.close()
+        return counts
+
+    def load_level(self, level, spool, counts, workers):
+        """
+        Loads the models of one dependency level, up to workers at a time,
+        each in its own thread and so its own connection
+        """
+        pending, errors = list(level), []
+        lock = threading.Lock()
+
+        def work():
+            try:
+                while True:
+                    with lock:
+                        if not pending or errors:
+                            return
+                        label = pending.pop(0)
+                    self.load_model(label, os.path.join(spool, label), counts[label])
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections[self.database].close()
+
+        if workers == 1 or len(level) == 1:
+            for label in level:
+                self.load_model(label, os.path.join(spool, label), counts[label])
+            return
+        threads = [threading.Thread(target=work) for _ in range(min(workers, len(level)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def load_model(self, label, path, count):
+        """
+        Bulk inserts the spooled objects of one model, batch_size at a
+        time, in one transaction
+        """
+        started = time.time()
+        with _atomic(using=self.database):
+            with open(path, 'rb') as f:
+                batch = []
+                for line in f:
+                    batch.append(json.loads(line))
+                    if len(batch) >= self.batch_size:
+                        self.insert(batch)
+                        batch = []
+                if batch:
+                    self.insert(batch)
+        if self.verbosity:
+            self.stdout.write('  %s: %d objects in %.1fs\n' % (label, count, time.time() - started))
+
+    def insert(self, batch):
+        objects = list(serializers.deserialize('python', batch, using=self.database))
+        model = objects[0].object.__class__
+        model._default_manager.using(self.database).bulk_create([o.object for o in objects])
+        for field in model._meta.many_to_many:
+            through = field.rel.through
+            if not through._meta.auto_created:
+                continue
+            source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+            through._default_manager.using(self.database).bulk_create([
+                through(**{'%s_id' % source: o.object.pk, '%s_id' % target: pk})
+                for o in objects for pk in o.m2m_data.get(field.name, ())])
+
+    def reset_sequences(self, counts):
+        connection = connections[self.database]
+        models = [get_model(*label.split('.')) for label in counts]
+        statements = connection.ops.sequence_reset_sql(no_style(), models)
+        if statements:
+            cursor = connection.cursor()
+            for sql in statements:
+                cursor.execute(sql)
+            if hasattr(transaction, 'commit_unless_managed'):
+                transaction.commit_unless_managed(using=self.database)
@@ -1,23 +1,87 @@
+import cPickle
+import imp
 import os
-from fabric.api import *
-
-from django.conf import settings
+from UserDict import DictMixin
 
 if os.environ.get('DJANGO_SETTINGS_MODULE'):
-    projectmodule = __import__(os.environ.get('DJANGO_SETTINGS_MODULE', ''))
-    PROJECT_NAME = projectmodule.__name__
+    # the top level package, without importing anything: django is only
+    # set up once a setting is actually looked at
+    PROJECT_NAME = os.environ['DJANGO_SETTINGS_MODULE'].split('.')[0]
 else:
     raise ImportError(
         "DJANGO_SETTINGS_MODULE must be available in environment. "
         "We recommend setting it in your venvs postactivate hook.")
 
-GLUE_SETTINGS = {
+# the merged settings are kept here between runs, until a file they come
+# from changes. GLUE_SETTINGS_SNAPSHOT='' turns this off, e.g. for settings
+# that read the environment
+SNAPSHOT_PATH = os.environ.get('GLUE_SETTINGS_SNAPSHOT', os.path.join('.glue', 'settings.pickle'))
+
+DEFAULTS = {
     'project_name': PROJECT_NAME,
     'project_group': 'web',
     'ssh_user': 'user',
     'ssh_host': 'host.net',
     'ssh_port': 30000,
+    'ssh_control_path': '~/.ssh/glue-%r@%h:%p',
+    'ssh_control_persist': '5m',
+    'warm_shell': True,
+    'deploy_pool_size': 5,
+    'deploy_batch_size': 1,
+    'incremental_perms': True,
+    'incremental_static': True,
+    'pipeline_jobs': 4,
+    # multi: project dirs ('path', or 'path:settings.module') and how many
+    # of them run at once per host
+    'projects': [],
+    'project_jobs': 4,
+    # where installreqs builds wheels locally (e.g. '.glue/wheelhouse'), or
+    # '' to pip install on the host. wheel_command has to build for the
+    # host's platform, e.g. in docker
+    'wheelhouse': '',
+    'wheel_command': 'pip wheel -q',
+    # putdata/loaddata: 'json' (dumpdata) or 'pg' (pg_dump/pg_restore)
+    'data_format': 'json',
+    'local_db_name': PROJECT_NAME,
+    'restore_jobs': 4,
+    # 0 loads json fixtures with django's loaddata. Otherwise with
+    # glue_loaddata (glue in INSTALLED_APPS, no multi-table inheritance) in
+    # batches of this many objects, models that don't depend on each other
+    # fixture_workers at a time
+    'fixture_batch_size': 0,
+    'fixture_workers': 1,
+    'warmup_concurrency': 8,
+    'warmup_rounds': 5,
+    'warmup_limit': 200,
+    'warmup_timeout': 30,
+    # trace of every task and remote command, written at the end of each
+    # run ('chrome' for chrome://tracing / Perfetto, or 'json'), and a line
+    # per run in history_file for `fab history`
+    'trace_file': '',
+    'trace_format': 'chrome',
+    'history_file': '.glue/history.jsonl',
+    # how often migrate samples the table locks its migrations take
+    'migration_lock_interval': 0.5,
+    # searchreindex: update_index processes and batch size, and whether to
+    # also remove objects deleted since (which walks the whole index)
+    'search_workers': 4,
+    'search_batch_size': 1000,
+    'search_remove': False,
+    # sizeworkers: overrides of how gunicorn is sized (workers_per_core,
+    # min_workers, max_workers, memory_fraction, worker_rss_mb, threads,
+    # max_threads, timeout), see glue.bottle._GUNICORN_POLICY
+    'gunicorn_policy': {},
+    # logstats: access logs (globs, relative to the project path) in the
+    # combined format with the request time last, e.g. gunicorn's
+    # --access-logformat '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s" %(L)s'
+    'access_logs': ['logs/gunicorn.log*'],
+    # syncmedia: parallel rsync streams, conflict policy (newer, local,
+    # remote or skip), and md5 for files whose mtime alone differs
+    'media_streams': 4,
+    'media_conflicts': 'newer',
+    'media_hash': False,
     'prod': {
+        'hosts': [],
         'process_name': PROJECT_NAME,
         'db_name': "%s_prod" % PROJECT_NAME,
         'db_user': PROJECT_NAME,
@@ -29,12 +93,33 @@ GLUE_SETTINGS = {
         'git_branch': '1.4',
         'memcached_enabled': False,
         'redis_enabled': False,
-        'redis_key': '',
+        'redis_key': '%s:generation' % PROJECT_NAME,
+        # e.g. '<project>:generation' to bump a generation key instead of
+        # flushing memcached after an update
+        'memcached_gen_key': '',
         'public_path': 'public',
         'media_path': 'media',
+        'static_path': 'static',
+        'reload_mode': 'hup',
+        'reload_timeout': 60,
+        'health_url': '',
+        # warmup after update: paths (joined to warmup_base_url, which may
+        # use %(host)s for the host being deployed) or full urls
+        'warmup_base_url': '',
+        'warmup_urls': [],
+        'warmup_sitemap': '',
+        'warmup_p95': 1.0,
+        # update also runs migrate (when migrations are pending) and
+        # searchreindex, once the code is in place
+        'migrate_on_update': False,
+        'search_index': False,
+        'releases': False,
+        'keep_releases': 5,
+        'shared_paths': ['public/media/', 'logs/', '%s/conf/env/secrets.cfg' % PROJECT_NAME],
     },
 
     'staging': {
+        'hosts': [],
         'process_name': "%s_staging" % PROJECT_NAME,
         'db_name': "%s_staging" % PROJECT_NAME,
         'db_user': PROJECT_NAME,
@@ -46,18 +131,127 @@ GLUE_SETTINGS = {
         'git_branch': '1.4',
         'memcached_enabled': False,
         'redis_enabled': False,
-        'redis_key': '',
+        'redis_key': '%s_staging:generation' % PROJECT_NAME,
+        # e.g. '<project>:generation' to bump a generation key instead of
+        # flushing memcached after an update
+        'memcached_gen_key': '',
         'public_path': 'public',
         'media_path': 'media',
+        'static_path': 'static',
+        'reload_mode': 'hup',
+        'reload_timeout': 60,
+        'health_url': '',
+        # warmup after update: paths (joined to warmup_base_url, which may
+        # use %(host)s for the host being deployed) or full urls
+        'warmup_base_url': '',
+        'warmup_urls': [],
+        'warmup_sitemap': '',
+        'warmup_p95': 1.0,
+        # update also runs migrate (when migrations are pending) and
+        # searchreindex, once the code is in place
+        'migrate_on_update': False,
+        'search_index': False,
+        'releases': False,
+        'keep_releases': 5,
+        'shared_paths': ['public/media/', 'logs/', '%s/conf/env/secrets.cfg' % PROJECT_NAME],
     }
 }
 
-temp_settings = getattr(settings, 'GLUE_SETTINGS', {})
-USER_SETTINGS = dict(GLUE_SETTINGS.items() + temp_settings.items())
-USER_SETTINGS['prod'] = dict(
-    GLUE_SETTINGS['prod'].items() + USER_SETTINGS.get('prod', {}).items()
-)
-USER_SETTINGS['staging'] = dict(
-    GLUE_SETTINGS['staging'].items() + USER_SETTINGS.get('staging', {}).items()
-)
-GLUE_SETTINGS = USER_SETTINGS
+def _merge(user):
+    merged = dict(DEFAULTS.items() + user.items())
+    for flavor in ('prod', 'staging'):
+        merged[flavor] = dict(DEFAULTS[flavor].items() + merged.get(flavor, {}).items())
+    return merged
+
+
+def _sources():
+    """
+    The files the settings can come from, with their mtimes: glue's
+    defaults and the .py files next to the settings module, which covers
+    local_settings.py and settings packages alike
+    """
+    files = [os.path.abspath(__file__).replace('.pyc', '.py')]
+    path = None
+    try:
+        for name in os.environ['DJANGO_SETTINGS_MODULE'].split('.'):
+            found = imp.find_module(name, path and [path] or None)
+            if found[0]:
+                found[0].close()
+            path = found[1]
+    except ImportError:
+        return None
+    directory = os.path.isdir(path) and path or os.path.dirname(path)
+    files += sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.endswith('.py'))
+    return [(f, os.path.getmtime(f)) for f in files if os.path.exists(f)]
+
+
+def _resolve():
+    """
+    The merged settings, from the snapshot when it is still current,
+    otherwise from django's settings (then snapshotted)
+    """
+    key = (os.environ['DJANGO_SETTINGS_MODULE'], _sources())
+    if SNAPSHOT_PATH and key[1] is not None:
+        try:
+            with open(SNAPSHOT_PATH, 'rb') as f:
+                snapshot_key, merged = cPickle.load(f)
+            if snapshot_key == key:
+                return merged
+        except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+            pass
+
+    from django.conf import settings
+    merged = _merge(getattr(settings, 'GLUE_SETTINGS', {}))
+    if SNAPSHOT_PATH and key[1] is not None:
+        try:
+            if not os.path.isdir(os.path.dirname(SNAPSHOT_PATH) or '.'):
+                os.makedirs(os.path.dirname(SNAPSHOT_PATH))
+            data = cPickle.dumps((key, merged), 2)
+        except (OSError, cPickle.PicklingError, TypeError):
+            # settings that can't be pickled are just resolved every run
+            return merged
+        # it holds db_pass and the other secrets, so only the user reads it,
+        # also when an older snapshot was written with the umask
+        fd = os.open(SNAPSHOT_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+    return merged
+
+
+class LazySettings(DictMixin):
+    """
+    GLUE_SETTINGS, resolved on first access, so importing glue.settings
+    (fab -l, or tasks that never read a setting) doesn't set django up
+    """
+    def __init__(self):
+        self._settings = None
+
+    def _resolved(self):
+        if self._settings is None:
+            self._settings = _resolve()
+        return self._settings
+
+    def __getitem__(self, key):
+        return self._resolved()[key]
+
+    def __setitem__(self, key, value):
+        self._resolved()[key] = value
+
+    def __delitem__(self, key):
+        del self._resolved()[key]
+
+    def keys(self):
+        return self._resolved().keys()
+
+    def __contains__(self, key):
+        return key in self._resolved()
+
+    def __iter__(self):
+        return iter(self._resolved())
+
+    def __repr__(self):
+        return repr(self._resolved())
+
+
+GLUE_SETTINGS = USER_SETTINGS = LazySettings()
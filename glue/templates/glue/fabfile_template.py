@@ -5,10 +5,18 @@ from fabric.api import *
 from fabric.colors import yellow, blue
 
 from glue.bottle import *
-from glue.bottle import _get_version
+from glue.bottle import _get_version, _hosts_for, _project_path
+# glue keeps local state (a snapshot of GLUE_SETTINGS with its secrets,
+# deploy history, media sync state) in .glue/ next to this file: add .glue/
+# to your .gitignore
 from glue.settings import GLUE_SETTINGS
 
-print yellow("""
+
+def _banner():
+    """
+    Printed once a flavor is picked, so `fab -l` stays quick and quiet
+    """
+    print yellow("""
                      M,
                    ,MMMM,_____
                  ,dMMMMMMMMMMMMMMMMb,_
@@ -45,17 +53,19 @@ print yellow("""
                                      '
 """)
 
-print "-------------------------------------------------------------"
-print blue('& twined deployment script v%s. copyright twined 2010-%s' % (
-    _get_version(), datetime.now().year))
-print "-------------------------------------------------------------"
-print ""
+    print "-------------------------------------------------------------"
+    print blue('& twined deployment script v%s. copyright twined 2010-%s' % (
+        _get_version(), datetime.now().year))
+    print "-------------------------------------------------------------"
+    print ""
 
 
 def prod():
     """
     Use the production server
     """
+    _banner()
+
     # the flavor of the django environment
     env.flavor = 'prod'
     # the process name, also the base name
@@ -67,8 +77,8 @@ def prod():
     env.host = GLUE_SETTINGS['ssh_host']
     # port for the ssh connection
     env.port = GLUE_SETTINGS['ssh_port']
-    # here we build the hosts string
-    env.hosts = ['%s@%s:%s' % (env.user, env.host, env.port)]
+    # here we build the hosts strings, one per host in the flavor's 'hosts'
+    env.hosts = _hosts_for('prod', GLUE_SETTINGS)
 
     # full path to virtualenvs root
     env.venv_root = GLUE_SETTINGS['prod']['venv_root']
@@ -76,8 +86,8 @@ def prod():
     env.venv_name = GLUE_SETTINGS['prod']['venv_name']
     # full path to the virtualenv we want to create
     env.venv_path = os.path.join(GLUE_SETTINGS['prod']['venv_root'], GLUE_SETTINGS['prod']['venv_name'])
-    # the path to clone our git repo into
-    env.path = os.path.join(GLUE_SETTINGS['prod']['project_base'], GLUE_SETTINGS['project_name'])
+    # the path to clone our git repo into, or the `current` release symlink
+    env.path = _project_path('prod', GLUE_SETTINGS)
     # name of the repo we are cloning
     env.repo = '%s' % GLUE_SETTINGS['prod']['repo']
     # branch name to clone, or empty for master
@@ -89,9 +99,10 @@ def prod():
     # gets chowned to
     env.project_group = GLUE_SETTINGS['project_group']
 
-    # if enabled, clears the memcached after git pulls
+    # if enabled, flushes memcached after git pulls, or bumps
+    # memcached_gen_key instead when that is set
     env.memcached_enabled = GLUE_SETTINGS['prod']['memcached_enabled']
-    # not implemented yet
+    # if enabled, bumps the redis generation key redis_key after git pulls
     env.redis_enabled = GLUE_SETTINGS['prod']['redis_enabled']
     env.redis_key = GLUE_SETTINGS['prod']['redis_key']
 
@@ -113,6 +124,8 @@ def staging():
     """
     Use the staging server
     """
+    _banner()
+
     # the flavor of the django environment
     env.flavor = 'staging'
     # the process name, also the base name
@@ -124,8 +137,8 @@ def staging():
     env.host = GLUE_SETTINGS['ssh_host']
     # port for the ssh connection
     env.port = GLUE_SETTINGS['ssh_port']
-    # here we build the hosts string
-    env.hosts = ['%s@%s:%s' % (env.user, env.host, env.port)]
+    # here we build the hosts strings, one per host in the flavor's 'hosts'
+    env.hosts = _hosts_for('staging', GLUE_SETTINGS)
 
     # full path to virtualenvs root
     env.venv_root = GLUE_SETTINGS['staging']['venv_root']
@@ -133,8 +146,8 @@ def staging():
     env.venv_name = GLUE_SETTINGS['staging']['venv_name']
     # full path to the virtualenv we want to create
     env.venv_path = os.path.join(GLUE_SETTINGS['staging']['venv_root'], GLUE_SETTINGS['staging']['venv_name'])
-    # the path to clone our git repo into
-    env.path = os.path.join(GLUE_SETTINGS['staging']['project_base'], GLUE_SETTINGS['project_name'])
+    # the path to clone our git repo into, or the `current` release symlink
+    env.path = _project_path('staging', GLUE_SETTINGS)
     # name of the repo we are cloning
     env.repo = '%s' % GLUE_SETTINGS['staging']['repo']
     # branch name to clone, or empty for master
@@ -146,9 +159,10 @@ def staging():
     # gets chowned to
     env.project_group = GLUE_SETTINGS['project_group']
 
-    # if enabled, clears the memcached after git pulls
+    # if enabled, flushes memcached after git pulls, or bumps
+    # memcached_gen_key instead when that is set
     env.memcached_enabled = GLUE_SETTINGS['staging']['memcached_enabled']
-    # not implemented yet
+    # if enabled, bumps the redis generation key redis_key after git pulls
     env.redis_enabled = GLUE_SETTINGS['staging']['redis_enabled']
     env.redis_key = GLUE_SETTINGS['staging']['redis_key']
 